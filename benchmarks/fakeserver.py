@@ -0,0 +1,323 @@
+""" A local stand-in for the openphoto/trovebox API, serving a synthetic
+    library of photos, albums and tags.
+"""
+import cgi
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+try:
+    from BaseHTTPServer import (BaseHTTPRequestHandler,
+                                HTTPServer)
+    from SocketServer import ThreadingMixIn
+    from urlparse import (parse_qs,
+                          urlparse)
+except ImportError:
+    from http.server import (BaseHTTPRequestHandler,
+                             HTTPServer)
+    from socketserver import ThreadingMixIn
+    from urllib.parse import (parse_qs,
+                              urlparse)
+
+__all__ = ["FakeServer", "Library"]
+
+
+def photo_content(id_, size):
+    seed = ("photo-%s-" % id_).encode("ascii")
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class Library(object):
+    """ Synthetic photos, each member of some albums and tags """
+
+    def __init__(self, photos=100, albums=10, tags=20, photo_size=64 * 1024,
+                 seed=0):
+        rnd = random.Random(seed)
+        self.photo_size = photo_size
+        self.photos = {}
+        self.hashes = {}
+        self.albums = defaultdict(list)
+        self.tags = defaultdict(list)
+        self._lock = threading.Lock()
+        for i in range(photos):
+            self.add_photo(str(i), "IMG_%05d.JPG" % i,
+                           hashlib.sha1(photo_content(i, photo_size))
+                           .hexdigest(), uploaded=1000000 + i)
+            if albums:
+                self.albums["album%d" % rnd.randrange(albums)].append(str(i))
+            for t in range(rnd.randrange(3)):
+                self.tags["tag%d" % rnd.randrange(tags or 1)].append(str(i))
+
+    def add_photo(self, id_, filename, hash_value, uploaded=None):
+        with self._lock:
+            self.photos[id_] = {
+                "id": id_,
+                "hash": hash_value,
+                "filenameOriginal": filename,
+                "dateUploaded": str(int(uploaded or time.time())),
+                "tags": [],
+                "albums": [],
+            }
+            self.hashes[hash_value] = id_
+            return self.photos[id_]
+
+    def content(self, id_):
+        return photo_content(int(id_), self.photo_size)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    routes = (
+        ("GET", r"^/photos/list\.json$", "photos_list"),
+        ("GET", r"^/photos/album-(?P<album>[^/]+)/list\.json$", "photos_list"),
+        ("GET", r"^/photos/tags-(?P<tag>[^/]+)/list\.json$", "photos_list"),
+        ("GET", r"^/photo/(?P<id>[^/]+)/view\.json$", "photo_view"),
+        ("POST", r"^/photo/(?P<id>[^/]+)/update\.json$", "photo_update"),
+        ("POST", r"^/photos/update\.json$", "photos_update"),
+        ("POST", r"^/photo/upload\.json$", "photo_upload"),
+        ("GET", r"^/albums/list\.json$", "albums_list"),
+        ("POST", r"^/album/create\.json$", "album_create"),
+        ("GET", r"^/tags/list\.json$", "tags_list"),
+        ("GET", r"^/original/(?P<id>[^/.]+)\.jpg$", "original"),
+    )
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def library(self):
+        return self.server.library
+
+    def photo(self, p):
+        res = dict(p)
+        res["pathOriginal"] = "http://%s:%d/original/%s.jpg" % (
+            self.server.server_address[0], self.server.server_address[1],
+            p["id"])
+        return res
+
+    def send_json(self, result, code=200, **extra):
+        body = dict(code=code, message="", result=result)
+        body.update(extra)
+        self.send_body(json.dumps(body).encode("utf-8"), code,
+                       "application/json")
+
+    def send_body(self, data, code=200, content_type="application/json",
+                  headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        for meth, regex, name in self.routes:
+            match = re.match(regex, url.path)
+            if meth == method and match:
+                self.server.count(name)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                if self.server.should_fail():
+                    return self.send_json(None, 503)
+                return getattr(self, name)(**match.groupdict())
+
+        self.send_json(None, 404)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.form = cgi.FieldStorage(
+            fp=self.rfile, headers=self.headers,
+            environ={"REQUEST_METHOD": "POST",
+                     "CONTENT_TYPE": self.headers.get("Content-Type", "")})
+        self.dispatch("POST")
+
+    def photos_list(self, album=None, tag=None):
+        lib = self.library
+        if album is not None:
+            ids = lib.albums.get(album, [])
+        elif tag is not None:
+            ids = lib.tags.get(tag, [])
+        else:
+            ids = sorted(lib.photos, key=int)
+            if self.query.get("sortBy", "").endswith(",desc"):
+                ids.reverse()
+
+        page_size = int(self.query.get("pageSize", 30))
+        page = max(1, int(self.query.get("page", 1)))
+        total_pages = max(1, (len(ids) + page_size - 1) // page_size)
+        chunk = ids[(page - 1) * page_size:page * page_size]
+        result = [self.photo(lib.photos[i]) for i in chunk]
+        for r in result:
+            r.update(totalRows=len(ids), totalPages=total_pages,
+                     currentPage=page, pageSize=page_size)
+        self.send_json(result)
+
+    def photo_view(self, id):
+        try:
+            self.send_json(self.photo(self.library.photos[id]))
+        except KeyError:
+            self.send_json(None, 404)
+
+    def photo_update(self, id):
+        try:
+            self.send_json(self.photo(self.library.photos[id]))
+        except KeyError:
+            self.send_json(None, 404)
+
+    def photos_update(self):
+        self.send_json(True)
+
+    def photo_upload(self):
+        item = self.form["photo"]
+        data = item.file.read()
+        hash_value = hashlib.sha1(data).hexdigest()
+        if hash_value in self.library.hashes:
+            return self.send_json(None, 409)
+        self.server.uploaded_bytes += len(data)
+        id_ = "u%d" % len(self.library.photos)
+        photo = self.library.add_photo(id_, item.filename or id_, hash_value)
+        self.send_json(self.photo(photo), 201)
+
+    def albums_list(self):
+        self.send_json([{"id": name, "name": name, "count": len(ids)}
+                        for name, ids in sorted(self.library.albums.items())])
+
+    def album_create(self):
+        name = self.form.getfirst("name")
+        self.library.albums.setdefault(name, [])
+        self.send_json({"id": name, "name": name, "count": 0}, 201)
+
+    def tags_list(self):
+        self.send_json([{"id": name, "count": len(ids)}
+                        for name, ids in sorted(self.library.tags.items())])
+
+    def original(self, id):
+        data = self.library.content(id)
+        self.server.downloaded_bytes += len(data)
+        range_ = self.headers.get("Range")
+        if range_:
+            start = int(range_.split("=")[1].split("-")[0])
+            if start >= len(data):
+                return self.send_body(b"", 416)
+            return self.send_body(
+                data[start:], 206, "image/jpeg",
+                {"Content-Range": "bytes %d-%d/%d" % (start, len(data) - 1,
+                                                      len(data))})
+        self.send_body(data, 200, "image/jpeg")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """ Serve a Library on localhost from a background thread.
+        latency (seconds) is added to every API call and error_rate
+        is the fraction of calls answered with a 503.
+    """
+
+    def __init__(self, library, latency=0, error_rate=0, seed=0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.library = library
+        self.httpd.latency = latency
+        self.httpd.calls = defaultdict(int)
+        self.httpd.uploaded_bytes = 0
+        self.httpd.downloaded_bytes = 0
+        self.httpd.count = self.count
+        self.httpd.should_fail = self.should_fail
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def host(self):
+        return "%s:%d" % self.httpd.server_address
+
+    @property
+    def calls(self):
+        return dict(self.httpd.calls)
+
+    def count(self, name):
+        with self._lock:
+            self.httpd.calls[name] += 1
+
+    def should_fail(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def serve(conn, library, latency, error_rate):
+    """ Run a FakeServer for ServerProcess, answering over conn """
+    with FakeServer(Library(**library), latency=latency,
+                    error_rate=error_rate) as server:
+        conn.send(server.host)
+        while conn.recv() == "stats":
+            conn.send((server.calls, server.httpd.downloaded_bytes +
+                       server.httpd.uploaded_bytes))
+
+
+class ServerProcess(object):
+    """ A FakeServer in its own process, so that its library and its
+        pages don't count in the memory of the tools benchmarked.
+        library holds the arguments of Library.
+    """
+
+    def __init__(self, latency=0, error_rate=0, **library):
+        self.library = library
+        self.latency = latency
+        self.error_rate = error_rate
+        self.conn = None
+        self.process = None
+        self.host = None
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve, args=(child, self.library, self.latency,
+                                self.error_rate))
+        self.process.daemon = True
+        self.process.start()
+        self.host = self.conn.recv()
+        return self
+
+    def stats(self):
+        """ (API calls by endpoint, bytes transferred) """
+        self.conn.send("stats")
+        return self.conn.recv()
+
+    def stop(self):
+        self.conn.send("stop")
+        self.process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,211 @@
+""" Run the tools against a local FakeServer and report throughput, API
+    call counts, peak RSS, bytes read and wall time as JSON.
+
+    python -m benchmarks.run --sizes 100,1000 --output bench.json
+    python -m benchmarks.run --baseline bench.json
+
+    Each scenario runs in its own interpreter so peak RSS is not shared,
+    and the FakeServer runs in another process so peak RSS is the tool's.
+    import_large imports a few --large-size files (one per 100 photos) to
+    show the read cost and memory use of hashing and uploading big RAWs.
+    list_photos only pages through the library, e.g. for a large one:
+
+    python -m benchmarks.run --scenario list_photos --sizes 500000 \
+        --photo-size 256 --latency 0.05
+    With --baseline the exit status is 1 when a scenario got slower than
+    the baseline by more than --tolerance, or made more API calls. A
+    missing baseline is created from the results, as tox -e bench does on
+    its first run.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from openphoto_utils.config import Config
+from .fakeserver import ServerProcess
+
+SCENARIOS = ("download_photos", "import_directories", "import_files",
+             "import_large", "list_photos")
+APPS = {"download_photos": "downloader",
+        "import_directories": "importer",
+        "import_files": "importer",
+        "import_large": "importer",
+        "list_photos": "downloader"}
+
+
+def make_config(app, host, default_dir):
+    config = Config(app, argparse.ArgumentParser())
+    config.parse_args([
+        "-H", host, "-K", "key", "-S", "secret", "-T", "token",
+        "-X", "secret", "--api-backoff", "0.01",
+    ])
+    config.default_dir = default_dir
+    config.importer = argparse.Namespace(refresh_hashes=False,
+                                         rebuild_hashes=False,
+                                         refresh_albums=False)
+    return config
+
+
+def make_files(directory, count, size):
+    for i in range(count):
+        seed = ("upload-%d-" % i).encode("ascii")
+        with open(os.path.join(directory, "IMG_%05d.jpg" % i), "wb") as f:
+            f.write((seed * (size // len(seed) + 1))[:size])
+
+
+def read_io():
+    """ (bytes read from storage, bytes read by syscalls) so far """
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["read_bytes"]), int(io["rchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def run_scenario(name, size, args):
+    from openphoto_utils import downloader, importer
+    from openphoto_utils.paging import iter_photos
+    workdir = tempfile.mkdtemp(prefix="openphoto-bench-")
+    try:
+        with ServerProcess(latency=args.latency, error_rate=args.error_rate,
+                           photos=size, albums=max(1, size // 50),
+                           tags=max(1, size // 20),
+                           photo_size=args.photo_size) as server:
+            config = make_config(APPS[name], server.host, workdir)
+            target = os.path.join(workdir, "target")
+            os.mkdir(target)
+            if name == "import_large":
+                make_files(target, max(2, size // 100), args.large_size)
+            elif name in ("import_directories", "import_files"):
+                make_files(target, size, args.photo_size)
+
+            read_before = read_io()
+            start = time.time()
+            if name == "download_photos":
+                downloader.download_photos(config, target, jobs=args.jobs)
+                count = size
+            elif name == "list_photos":
+                count = sum(1 for _ in iter_photos(config.client))
+            elif name in ("import_directories", "import_large"):
+                importer.import_directories(config, [target],
+                                            compare_hash=True,
+                                            jobs=args.jobs)
+                count = len(os.listdir(target))
+            else:
+                files = [os.path.join(target, f) for f in os.listdir(target)]
+                importer.import_files(config, files, compare_hash=True,
+                                      jobs=args.jobs)
+                count = len(files)
+            wall = time.time() - start
+            read_after = read_io()
+
+            calls, transferred = server.stats()
+    finally:
+        shutil.rmtree(workdir, True)
+
+    return {
+        "scenario": name,
+        "size": size,
+        "wall_time": wall,
+        "photos_per_second": count / max(wall, 0.001),
+        "mb_per_second": transferred / (1024.0 * 1024.0) / max(wall, 0.001),
+        "api_calls": sum(calls.values()),
+        "api_calls_by_endpoint": calls,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "read_bytes": read_after[0] - read_before[0],
+        "read_syscall_bytes": read_after[1] - read_before[1],
+    }
+
+
+def spawn(name, size, args):
+    cmd = [sys.executable, "-m", "benchmarks.run", "--child",
+           "--scenario", name,
+           "--sizes", str(size), "--jobs", str(args.jobs),
+           "--latency", str(args.latency),
+           "--error-rate", str(args.error_rate),
+           "--photo-size", str(args.photo_size),
+           "--large-size", str(args.large_size)]
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    old = dict(((r["scenario"], r["size"]), r) for r in baseline)
+    regressions = []
+    for r in results:
+        b = old.get((r["scenario"], r["size"]))
+        if not b:
+            continue
+        if r["wall_time"] > b["wall_time"] * (1 + tolerance):
+            regressions.append("%s[%d]: wall time %.2fs -> %.2fs" % (
+                r["scenario"], r["size"], b["wall_time"], r["wall_time"]))
+        if r["api_calls"] > b["api_calls"]:
+            regressions.append("%s[%d]: api calls %d -> %d" % (
+                r["scenario"], r["size"], b["api_calls"], r["api_calls"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="100,1000",
+                        help="Comma separated library sizes")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Scenario to run (default: all)")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds added to every API call")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of API calls answered with a 503")
+    parser.add_argument("--photo-size", type=int, default=64 * 1024)
+    parser.add_argument("--large-size", type=int, default=32 * 1024 * 1024,
+                        help="Size of the files of import_large")
+    parser.add_argument("--output", help="Write results to this file")
+    parser.add_argument("--baseline", help="Compare with these results")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    if args.child:
+        print(json.dumps(run_scenario(args.scenario[0], sizes[0], args)))
+        return 0
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        for size in sizes:
+            results.append(spawn(name, size, args))
+            sys.stderr.write("%(scenario)s[%(size)d]: %(wall_time).2fs, "
+                             "%(photos_per_second).1f photos/s, "
+                             "%(api_calls)d calls, %(peak_rss_kb)d KB\n"
+                             % results[-1])
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+
+    if args.baseline and not os.path.exists(args.baseline):
+        sys.stderr.write("No baseline yet, saving the results to %s\n"
+                         % args.baseline)
+        with open(args.baseline, "w") as f:
+            f.write(data)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            sys.stderr.write("REGRESSION %s\n" % r)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+""" Measure how long the entry points take to start, as JSON.
+
+    python -m benchmarks.startup --runs 10 --output startup.json
+    python -m benchmarks.startup --baseline startup.json
+
+    Every command runs in a fresh interpreter. "--help" shows the cost of
+    importing the entry point itself, "import" the cost of each module, and
+    heavy_modules lists the expensive dependencies loaded by --help (it
+    should stay empty). Where the interpreter supports -X importtime the
+    slowest imports of the tools are reported too.
+"""
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+    "downloader --help": "from openphoto_utils import cli; "
+                         "cli.downloader(['--help'])",
+    "importer --help": "from openphoto_utils import cli; "
+                       "cli.importer(['--help'])",
+    "shell --help": "from openphoto_utils import cli; cli.shell(['--help'])",
+    "serve --help": "from openphoto_utils import cli; cli.serve(['--help'])",
+    "import downloader": "import openphoto_utils.downloader",
+    "import importer": "import openphoto_utils.importer",
+}
+HEAVY = ("openphoto", "requests", "sqlite3", "openphoto_utils.downloader",
+         "openphoto_utils.importer")
+
+
+def time_command(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        with open("/dev/null", "w") as null:
+            subprocess.call([sys.executable, "-c", code], stdout=null,
+                            stderr=null)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def heavy_modules():
+    code = ("import sys, json\n"
+            "from openphoto_utils import cli\n"
+            "try:\n    cli.downloader(['--help'])\n"
+            "except SystemExit:\n    pass\n"
+            "sys.stderr.write(json.dumps(sorted(m for m in %r "
+            "if m in sys.modules)))\n" % (HEAVY, ))
+    with open("/dev/null", "w") as null:
+        proc = subprocess.Popen([sys.executable, "-c", code], stdout=null,
+                                stderr=subprocess.PIPE)
+        err = proc.communicate()[1]
+    return json.loads(err.decode("utf-8").strip().splitlines()[-1])
+
+
+def import_times(top=10):
+    """ The slowest cumulative imports of the tools, in microseconds """
+    if sys.version_info < (3, 7):
+        return None
+
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c",
+                             "import openphoto_utils.downloader, "
+                             "openphoto_utils.importer"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = proc.communicate()[1].decode("utf-8")
+    times = []
+    for line in err.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)", line)
+        if m:
+            times.append((int(m.group(2)), m.group(3)))
+    times.sort(reverse=True)
+    return dict((name, us) for us, name in times[:top])
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, wall in sorted(results["commands"].items()):
+        old = baseline.get("commands", {}).get(name)
+        if old and wall > old * (1 + tolerance):
+            regressions.append("%s: %.3fs -> %.3fs" % (name, old, wall))
+    new = set(results["heavy_modules"]) - \
+        set(baseline.get("heavy_modules", []))
+    if new:
+        regressions.append("--help now imports %s" % (", ".join(sorted(new))))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Runs per command, the median is reported")
+    parser.add_argument("--output", help="Write results to this file")
+    parser.add_argument("--baseline", help="Compare with these results")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    baseline = time_command("pass", args.runs)
+    results = {
+        "interpreter": baseline,
+        "commands": dict((name, time_command(code, args.runs))
+                         for name, code in COMMANDS.items()),
+        "heavy_modules": heavy_modules(),
+        "import_times_us": import_times(),
+    }
+    for name, wall in sorted(results["commands"].items()):
+        sys.stderr.write("%-20s %.3fs (%.3fs over the interpreter)\n" % (
+            name, wall, wall - baseline))
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            sys.stderr.write("REGRESSION %s\n" % r)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+""" Run the downloader or the importer for many accounts from one file.
+    Each [account:NAME] section holds the [api] options of an account and
+    the options of its tool; the [api], [stats], [downloader] and
+    [importer] sections of the file are shared by all the accounts:
+
+    [batch]
+    jobs = 16
+
+    [downloader]
+    jobs = 4
+
+    [account:alice]
+    host = alice.trovebox.com
+    consumer_key = ...
+    photo_directory = /srv/photos/alice
+    file = /var/lib/node_exporter/alice.prom
+    format = prometheus
+
+    [account:bob]
+    host = bob.trovebox.com
+    ...
+    tool = importer
+    args = -r -C -c /srv/uploads/bob
+
+    The accounts run concurrently, each in its own thread and with its own
+    client, statistics and exit status. Together they use at most the
+    jobs of the [batch] section: an account starts, in order, once as
+    many workers as its tool would start threads are free (e.g. jobs,
+    link_jobs and the listing thread for the downloader). The pools of an
+    account needing more than the whole batch are scaled down.
+"""
+import ConfigParser
+import logging
+import shlex
+import threading
+import time
+from . import instrument
+from .main import run
+from .workers import Budget
+
+__all__ = ["Account", "read_accounts", "run_batch"]
+log = logging.getLogger(__name__)
+PREFIX = "account:"
+BATCH_TOOLS = ("downloader", "importer")
+# the thread pools each tool starts, besides the one listing the photos
+POOLS = {
+    "downloader": ("jobs", "link_jobs"),
+    "importer": ("jobs", "hash_jobs"),
+}
+MIN_WORKERS = 3
+
+
+class Account(object):
+
+    def __init__(self, name, section, tool, argv):
+        self.name = name
+        self.section = section
+        self.tool = tool
+        self.argv = argv
+        self.job = None
+        self.rc = None
+        self.elapsed = 0.0
+        self.stats = None
+
+    def prepare(self, path):
+        """ Parse the options of the account, as the tool would """
+        from .cli import TOOLS
+        try:
+            self.job = TOOLS[self.tool](self.argv, (path, self.section))
+        except SystemExit as e:
+            # argparse already printed the error
+            log.error("%s: invalid options", self.name)
+            self.rc = e.code if isinstance(e.code, int) else 2
+
+    @property
+    def workers(self):
+        """ Threads the tool will start with the parsed options """
+        kwargs = self.job[3]
+        return 1 + sum(kwargs.get(pool) or 1 for pool in POOLS[self.tool])
+
+    def scale(self, workers):
+        """ Shrink the pools of the tool to fit in workers threads """
+        kwargs = self.job[3]
+        pools = POOLS[self.tool]
+        wanted = self.workers - 1
+        available = max(len(pools), workers - 1)
+        for pool in pools:
+            kwargs[pool] = max(1, (kwargs.get(pool) or 1) * available //
+                               wanted)
+        if "jobs_per_host" in kwargs:
+            kwargs["jobs_per_host"] = min(kwargs["jobs_per_host"],
+                                          kwargs["jobs"])
+
+    def run(self, budget, workers):
+        instrument.bind(instrument.Registry())
+        config, fun, args, kwargs = self.job
+        start = time.time()
+        try:
+            log.info("%s: running %s with %d workers", self.name, self.tool,
+                     workers)
+            self.rc = run(fun, config, *args, **kwargs)
+        finally:
+            budget.release(workers)
+            self.elapsed = time.time() - start
+            self.stats = instrument.snapshot()
+        log.info("%s: finished with status %s in %.1fs", self.name, self.rc,
+                 self.elapsed)
+
+
+def read_accounts(path, names=None):
+    """ (jobs of the [batch] section or None, accounts) in file order """
+    config = ConfigParser.RawConfigParser()
+    with open(path) as f:
+        config.readfp(f)
+
+    def option(section, name, default=None):
+        if config.has_option(section, name):
+            return config.get(section, name)
+        return default
+
+    tool = option("batch", "tool", "downloader")
+    jobs = option("batch", "jobs")
+    accounts = []
+    for section in config.sections():
+        if not section.startswith(PREFIX):
+            continue
+        name = section[len(PREFIX):]
+        if names and name not in names:
+            continue
+        accounts.append(Account(name, section, option(section, "tool", tool),
+                                shlex.split(option(section, "args", ""))))
+
+    missing = set(names or ()) - set(a.name for a in accounts)
+    if missing:
+        raise ValueError("No account %s" % ", ".join(sorted(missing)))
+    for account in accounts:
+        if account.tool not in BATCH_TOOLS:
+            raise ValueError("%s: unknown tool %s" % (account.name,
+                                                      account.tool))
+    return int(jobs) if jobs else None, accounts
+
+
+def run_batch(path, names=None, jobs=None):
+    """ Run the accounts of the batch file path with at most jobs workers
+        in total, and return the worst exit status
+    """
+    logging.basicConfig(level=logging.INFO)
+    try:
+        default_jobs, accounts = read_accounts(path, names)
+    except (IOError, OSError, ValueError, ConfigParser.Error) as e:
+        log.error("Cannot read %s: %s", path, e)
+        return 2
+
+    # parse everything before running: reading the config files may
+    # reconfigure logging
+    for account in accounts:
+        account.prepare(path)
+
+    size = jobs or default_jobs or 8
+    if size < MIN_WORKERS:
+        log.warning("Using %d workers, the least an account needs",
+                    MIN_WORKERS)
+        size = MIN_WORKERS
+
+    budget = Budget(size)
+    threads = []
+    try:
+        for account in accounts:
+            if account.job is None:
+                continue
+            workers = budget.acquire(account.workers)
+            if workers < account.workers:
+                log.warning("%s: only %d workers in the batch, not %d",
+                            account.name, workers, account.workers)
+                account.scale(workers)
+            t = threading.Thread(target=account.run, args=(budget, workers),
+                                 name="account-%s" % account.name)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            # join with a timeout so KeyboardInterrupt is delivered
+            while t.is_alive():
+                t.join(0.5)
+
+    except KeyboardInterrupt:
+        log.info("Terminated.")
+        return 2
+
+    report(accounts)
+    return max([2 if a.rc is None else a.rc for a in accounts] + [0])
+
+
+def report(accounts):
+    for account in accounts:
+        counters = account.stats["counters"] if account.stats else {}
+        print("%-20s %-10s status %-3s %8.1fs %s" % (
+            account.name, account.tool, account.rc, account.elapsed,
+            " ".join("%s=%d" % kv for kv in sorted(counters.items()))))
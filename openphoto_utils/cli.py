@@ -0,0 +1,322 @@
+""" Console entry points.
+    Only argument parsing happens here: the tools, openphoto and requests
+    are imported once the arguments are known to be good, so --help and
+    usage errors return quickly.
+"""
+import argparse
+import logging
+import os
+import sys
+from .config import Config
+from .layout import MODES
+from .main import run
+from .scanner import Scanner
+
+__all__ = ["batch", "downloader", "importer", "shell", "serve", "verify",
+           "TOOLS"]
+log = logging.getLogger(__name__)
+SHELLS = ("ipython", "bpython", "default", "auto")
+
+
+def parse_downloader(argv=None, profile=None):
+    parser = argparse.ArgumentParser(description="Download photos from openphoto/trovebox")
+    config = Config("downloader", parser)
+    config.add_argument("-d", "--photo-directory", help="Photo directory", required=True)
+    config.add_argument("-c", "--photo-cache-directory",
+                        help="Search for photo in this directory before downloading")
+    config.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of concurrent downloads (default: 1)")
+    config.add_argument("--jobs-per-host", type=int, default=4,
+                        help="Max concurrent downloads from a single host "
+                        "(default: 4)")
+    config.add_argument("-i", "--incremental", action="store_true",
+                        default=False,
+                        help="Only fetch what changed since the last run")
+    config.add_argument("--verify", action="store_true", default=False,
+                        help="Rehash already downloaded photos and fetch "
+                        "them again if corrupted")
+    config.add_argument("--link-jobs", type=int, default=4,
+                        help="Number of albums/tags fetched concurrently "
+                        "(default: 4)")
+    config.add_argument("--link-mode", choices=MODES, default="hardlink",
+                        help="How albums and tags point to the photos "
+                        "(default: hardlink)")
+    config.add_argument("--date-folders", action="store_true", default=False,
+                        help="Also lay out photos in dates/YYYY/MM")
+    config.add_argument("--shard", metavar="I/N",
+                        help="Only download the I-th of N disjoint subsets "
+                        "of the photos (1 <= I <= N), without making links")
+    config.add_argument("--merge", action="store_true", default=False,
+                        help="Only make the links, once all the shards are "
+                        "downloaded")
+    config.parse_args(argv, profile)
+    shard = None
+    if config.downloader.shard:
+        try:
+            shard = tuple(int(p) for p in
+                          config.downloader.shard.split("/"))
+            if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+                raise ValueError()
+        except ValueError:
+            parser.error("--shard must be I/N with 1 <= I <= N")
+        if config.downloader.merge:
+            parser.error("Conflicting options --shard and --merge")
+
+    if config.downloader.photo_cache_directory:
+        cache = os.path.realpath(config.downloader.photo_cache_directory)
+    else:
+        cache = None
+
+    from .downloader import download_photos
+    return config, download_photos, (
+        os.path.realpath(config.downloader.photo_directory), cache), dict(
+        jobs=int(config.downloader.jobs),
+        jobs_per_host=int(config.downloader.jobs_per_host),
+        incremental=config.downloader.incremental,
+        verify=config.downloader.verify,
+        link_jobs=int(config.downloader.link_jobs),
+        link_mode=config.downloader.link_mode,
+        date_folders=config.downloader.date_folders,
+        shard=shard, merge=config.downloader.merge)
+
+
+def parse_importer(argv=None, profile=None):
+    parser = argparse.ArgumentParser(
+        description="Import photos to openphoto/trovebox")
+    config = Config("importer", parser)
+    config.add_argument("target", help="Directory or file to upload",
+                        required=True, nargs="+")
+    config.add_argument("-a", "--album", help="Create album(s)")
+    config.add_argument("-r", "--recurse", help="Recurse into subdirectories",
+                        action="store_true", default=False)
+    config.add_argument("-C", "--create-albums", action="store_true",
+                        help="Create albums from directories", default=False)
+    config.add_argument("--refresh-albums", action="store_true",
+                        default=False,
+                        help="Ignore the stored list of remote albums")
+    config.add_argument("-c", "--hashes", action="store_true",
+                        help="Compare hashes before uploading", default=False)
+    config.add_argument("--refresh-hashes", action="store_true",
+                        default=False,
+                        help="Fetch hashes of photos uploaded since the "
+                        "last refresh")
+    config.add_argument("--rebuild-hashes", action="store_true",
+                        default=False,
+                        help="Discard stored hashes and fetch all of them")
+    config.add_argument("--rehash", action="store_true", default=False,
+                        help="Ignore cached hashes of local files")
+    config.add_argument("-i", "--include", action="append",
+                        help="Only import files matching this glob (can be "
+                        "specified multiple times)")
+    config.add_argument("-x", "--exclude", action="append",
+                        help="Skip files and directories matching this glob "
+                        "(can be specified multiple times)")
+    config.add_argument("-e", "--extension", action="append",
+                        help="Only import files with this extension (can be "
+                        "specified multiple times)")
+    config.add_argument("--magic", action="store_true", default=False,
+                        help="Only import files which look like images")
+    config.add_argument("--resume-scan", action="store_true", default=False,
+                        help="Resume the scan where the last run stopped")
+    config.add_argument("--resume", action="store_true", default=False,
+                        help="Skip files already handled by a previous run")
+    config.add_argument("--retry-failed", action="store_true", default=False,
+                        help="Only retry files which failed in previous runs")
+    config.add_argument("-t", "--tag", action="append",
+                        help="Add tags to photos (can be \
+                        specified multiple times)")
+    config.add_argument("-R", "--remove-tag", action="append",
+                        help="Remove tags from photos (can be \
+                        specified multiple times)")
+    config.add_argument("--public", action="store_true",
+                        default=False, help="Make photos public")
+    config.add_argument(
+        '--skip-update-if-hashed', "-U", action="store_true",
+        default=False,
+        help="Do not update metadata if photo is found in hashes")
+    config.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of concurrent uploads (default: 1)")
+    config.add_argument("--hash-jobs", type=int, default=2,
+                        help="Number of files hashed concurrently "
+                        "(default: 2)")
+    config.add_argument("--update-batch-size", type=int, default=50,
+                        help="Number of already uploaded photos updated "
+                        "per request (default: 50)")
+    config.add_argument("-w", "--watch", action="store_true", default=False,
+                        help="Keep running and import new or modified files "
+                        "as they appear")
+    config.add_argument("--watch-debounce", type=float, default=5.0,
+                        help="Seconds a file must stay unchanged before "
+                        "being imported (default: 5)")
+    config.add_argument("--watch-poll", type=float, default=30.0,
+                        help="Seconds between scans when inotify is not "
+                        "available (default: 30)")
+    config.parse_args(argv, profile)
+
+    if config.importer.album and config.importer.create_albums:
+        parser.error("Conflicting options --album and --create-albums")
+
+    if not all(os.path.isdir(t) for t in config.importer.target) and \
+       not all(os.path.isfile(t) for t in config.importer.target):
+        parser.error("Cannot mix files and directories")
+
+    from . import importer
+    if os.path.isdir(config.importer.target[0]):
+        func = importer.import_directories
+        if len(config.importer.target) > 1:
+            if config.importer.album:
+                parser.error("Cannot set --album with multiple target dirs")
+        if config.importer.recurse and not config.importer.create_albums:
+            log.warn("--recurse enables --create-albums")
+
+    else:
+        if config.importer.watch:
+            parser.error("--watch needs directories")
+        func = importer.import_files
+
+    kwargs = dict(
+        album=config.importer.album,
+        recurse=config.importer.recurse,
+        create_albums=config.importer.create_albums,
+        compare_hash=config.importer.hashes,
+        rehash=config.importer.rehash,
+        tags=config.importer.tag, public=config.importer.public,
+        remove_tags=config.importer.remove_tag,
+        skip_update_if_hashed=config.importer.skip_update_if_hashed,
+        jobs=int(config.importer.jobs),
+        hash_jobs=int(config.importer.hash_jobs),
+        update_batch_size=int(config.importer.update_batch_size),
+        scanner=Scanner(recurse=config.importer.recurse,
+                        include=config.importer.include,
+                        exclude=config.importer.exclude,
+                        extensions=config.importer.extension,
+                        magic=config.importer.magic),
+        resume_scan=config.importer.resume_scan,
+        resume=config.importer.resume,
+        retry_failed=config.importer.retry_failed)
+    if func is importer.import_directories:
+        kwargs.update(watch=config.importer.watch,
+                      watch_debounce=float(config.importer.watch_debounce),
+                      watch_poll=float(config.importer.watch_poll))
+    return config, func, (config.importer.target, ), kwargs
+
+
+def parse_shell(argv=None, profile=None):
+    parser = argparse.ArgumentParser(
+        description="Drop a shell with a configured client"
+    )
+    config = Config("shell", parser)
+    config.add_argument("--shell", help="Shell to use (defaults to auto)",
+                        choices=SHELLS, default="auto")
+
+    config.parse_args(argv, profile)
+    from .shell import select_shell
+    return config, select_shell, (config.shell.shell, ), {}
+
+
+def parse_verify(argv=None, profile=None):
+    parser = argparse.ArgumentParser(
+        description="Check the photos mirrored by the downloader against "
+        "openphoto/trovebox")
+    config = Config("verify", parser)
+    config.add_argument("-d", "--photo-directory", required=True,
+                        help="Photo directory given to the downloader")
+    config.add_argument("-j", "--jobs", type=int, default=0,
+                        help="Number of processes hashing files "
+                        "(default: one per CPU)")
+    config.add_argument("--repair", action="store_true", default=False,
+                        help="Download missing and mismatched photos again")
+    config.add_argument("--download-jobs", type=int, default=4,
+                        help="Number of concurrent downloads with --repair "
+                        "(default: 4)")
+    config.add_argument("--rehash", action="store_true", default=False,
+                        help="Hash every file, even the ones verified by "
+                        "previous audits")
+    config.parse_args(argv, profile)
+
+    from .verify import audit
+    return config, audit, (
+        os.path.realpath(config.verify.photo_directory), ), dict(
+        jobs=int(config.verify.jobs) or None,
+        repair=config.verify.repair,
+        rehash=config.verify.rehash,
+        download_jobs=int(config.verify.download_jobs))
+
+
+# tools which can be run by the serve daemon
+TOOLS = {
+    "downloader": parse_downloader,
+    "importer": parse_importer,
+    "verify": parse_verify,
+}
+
+
+def run_tool(parse, argv=None):
+    config, fun, args, kwargs = parse(argv)
+    return run(fun, config, *args, **kwargs)
+
+
+def downloader(argv=None):
+    return run_tool(parse_downloader, argv)
+
+
+def importer(argv=None):
+    return run_tool(parse_importer, argv)
+
+
+def shell(argv=None):
+    return run_tool(parse_shell, argv)
+
+
+def verify(argv=None):
+    return run_tool(parse_verify, argv)
+
+
+def batch(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the downloader or the importer for all the "
+        "accounts of a batch file")
+    parser.add_argument("config", help="Batch file")
+    parser.add_argument("-a", "--account", action="append",
+                        help="Only run this account (can be specified "
+                        "multiple times)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Workers shared by all the accounts (default: "
+                        "jobs in the [batch] section, or 8)")
+    args = parser.parse_args(argv)
+
+    from .batch import run_batch
+    return run_batch(os.path.realpath(args.config), args.account, args.jobs)
+
+
+def serve(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Keep a warm client around and run the downloader and "
+        "the importer on request")
+    parser.add_argument("-s", "--socket",
+                        default=os.path.join(Config.default_dir,
+                                             "serve.sock"),
+                        help="Unix socket to listen on (default: %(default)s)")
+    parser.add_argument("--call", choices=sorted(TOOLS),
+                        help="Ask a running server to run this tool with "
+                        "the remaining arguments, and exit with its status")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    from . import daemon
+    logging.basicConfig(level=logging.INFO)
+    if args.call:
+        argv = args.args[1:] if args.args[:1] == ["--"] else args.args
+        return daemon.call(args.socket, args.call, argv)
+
+    return daemon.serve(args.socket)
+
+
+if __name__ == '__main__':
+    tool = sys.argv.pop(1) if len(sys.argv) > 1 else None
+    if tool not in ("batch", "downloader", "importer", "shell", "serve",
+                    "verify"):
+        sys.exit("usage: python -m openphoto_utils.cli "
+                 "{batch,downloader,importer,shell,serve,verify} ...")
+    sys.exit(globals()[tool]())
@@ -4,7 +4,9 @@ import logging
 import logging.config
 import os
 import ConfigParser
-from openphoto import Client
+from .ratelimit import (RateLimiter,
+                        parse_rate,
+                        shared_path)
 
 
 __all__ = ["Config"]
@@ -139,12 +141,20 @@ class Section(object):
 
 
 class Config(object):
+    """ Options of a tool, from the command line, the environment and the
+        config files.
+        The client and the HTTP session are only built when first used, so
+        that --help and argument errors don't pay for importing them.
+    """
     default_dir = os.path.dirname(DEFAULT_CONFIG_PATH)
 
     def __init__(self, app_name, parser, config_section=None):
         self.parser = parser
         self.sections = []
         self.configs = []
+        self._client = None
+        self._session = None
+        self.limiter = None
         self.parser.add_argument("config", help="Config file", nargs="?")
         self.app_name = app_name
         section_name = config_section or app_name
@@ -161,7 +171,39 @@ class Config(object):
         self.api.add_argument("-X", "--api-oauth-secret", help="API oauth secret",
                               env="tokenSecret", required=True)
         self.api.add_argument("--api-debug-http", help="Set debug level on httplib")
-        self.parse_config(DEFAULT_CONFIG_PATH)
+        self.api.add_argument("--api-pool-size", type=int, default=10,
+                              help="HTTP connections kept alive per host")
+        self.api.add_argument("--api-timeout", type=float, default=60,
+                              help="HTTP timeout in seconds")
+        self.api.add_argument("--api-retries", type=int, default=5,
+                              help="Retries on connection errors and 5xx/429")
+        self.api.add_argument("--api-backoff", type=float, default=0.5,
+                              help="Exponential backoff factor between retries")
+        self.api.add_argument("--max-rps", dest="api_max_rps",
+                              help="Maximum API requests per second")
+        self.api.add_argument("--max-bandwidth", dest="api_max_bandwidth",
+                              help="Maximum bytes per second sent and "
+                              "received, e.g. 512K or 2M")
+        self.api.add_argument("--rate-limit-file", dest="api_rate_limit_file",
+                              help="File through which the tools of this "
+                              "user share the limits (default: one per API "
+                              "host in $XDG_RUNTIME_DIR or the config "
+                              "directory)")
+        self.api.add_argument("--no-shared-rate-limit",
+                              dest="api_no_shared_rate_limit",
+                              action="store_true", default=False,
+                              help="Apply the limits to this process only")
+
+        self.add_section("stats", args_pfx="stats_")
+        self.stats.add_argument("--stats", dest="stats_summary",
+                                action="store_true", default=False,
+                                help="Print statistics when done")
+        self.stats.add_argument("--stats-file",
+                                help="Write statistics to this file")
+        self.stats.add_argument("--stats-format", default="json",
+                                choices=("json", "prometheus"),
+                                help="Format of --stats-file "
+                                "(default: json)")
         self.section = self.add_section(section_name, args_pfx="")
 
     def parse_config(self, filename):
@@ -188,6 +230,31 @@ class Config(object):
         else:
             return self.configs[0]
 
+    def parse_profile(self, filename, name):
+        """ Use the options of section name in filename, as for an account
+            of the batch runner: each option goes to the sections which
+            know it, overriding the other config files. The sections of
+            filename itself apply as usual.
+            The tools keep the state of the account (stored hashes,
+            albums, journals) in its own directory below default_dir.
+        """
+        config = self.parse_config(filename)
+        if config is None or not config.has_section(name):
+            self.parser.error("No section %s in %s" % (name, filename))
+
+        profile = ConfigParser.RawConfigParser()
+        for s in self.sections:
+            profile.add_section(s.name)
+            for opt in config.options(name):
+                if opt in s.args:
+                    profile.set(s.name, opt, config.get(name, opt))
+        self.configs.insert(0, profile)
+
+        self.default_dir = os.path.join(self.default_dir, "accounts",
+                                        name.split(":")[-1])
+        if not os.path.isdir(self.default_dir):
+            os.makedirs(self.default_dir)
+
     def add_section(self, section, args_pfx=None, env_pfx=None, description=None):
         group = self.parser.add_argument_group(section, description)
         sect = Section(section, group, args_pfx, env_pfx)
@@ -198,9 +265,12 @@ class Config(object):
     def add_argument(self, *args, **kwargs):
         self.section.add_argument(*args, **kwargs)
 
-    def parse_args(self, args=None):
+    def parse_args(self, args=None, profile=None):
         parsed_args = self.parser.parse_args(args)
+        self.parse_config(DEFAULT_CONFIG_PATH)
         self.parse_config(parsed_args.config)
+        if profile is not None:
+            self.parse_profile(*profile)
 
         for s in self.sections:
             try:
@@ -209,15 +279,80 @@ class Config(object):
             except KeyError as e:
                 self.parser.error("Missing required argument %s in %s section" % (e, s.name))
 
+        self.limiter = self.make_limiter()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.make_client()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self.make_session()
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def make_client(self):
+        from openphoto import Client
+        from .transport import (make_adapter,
+                                mount)
+
         log.debug("Creating client for %s", self.api.host)
         try:
             debug_level = int(self.api.debug_http)
         except (TypeError, ValueError) as e:
             debug_level = None
 
-        self.client = Client(self.api.host,
-                             self.api.consumer_key,
-                             self.api.consumer_secret,
-                             self.api.oauth_token,
-                             self.api.oauth_secret,
-                             http_debug_level=debug_level)
+        client = Client(self.api.host,
+                        self.api.consumer_key,
+                        self.api.consumer_secret,
+                        self.api.oauth_token,
+                        self.api.oauth_secret,
+                        http_debug_level=debug_level)
+
+        # reuse the same pooling/retry/timeout policy on the client's own
+        # session
+        client_session = getattr(client, "session", None)
+        if client_session is not None:
+            mount(client_session, make_adapter(int(self.api.pool_size),
+                                               int(self.api.retries),
+                                               float(self.api.backoff),
+                                               self.limiter,
+                                               float(self.api.timeout)))
+        else:
+            log.warning("This openphoto client has no session: its requests "
+                        "are not pooled, retried, throttled nor timed out")
+        return client
+
+    def make_session(self):
+        from .transport import make_session
+        return make_session(int(self.api.pool_size),
+                            float(self.api.timeout),
+                            int(self.api.retries),
+                            float(self.api.backoff),
+                            self.limiter)
+
+    def make_limiter(self):
+        try:
+            max_rps = parse_rate(self.api.max_rps)
+            max_bandwidth = parse_rate(self.api.max_bandwidth)
+        except ValueError as e:
+            self.parser.error(str(e))
+
+        if not max_rps and not max_bandwidth:
+            return None
+
+        path = None
+        if self.api.no_shared_rate_limit not in (True, "1", "true", "yes"):
+            path = self.api.rate_limit_file or shared_path(
+                self.api.host, Config.default_dir)
+        return RateLimiter(max_rps, max_bandwidth, path)
@@ -0,0 +1,131 @@
+""" A long running process running the tools on request.
+    The modules stay imported and clients (with their keep-alive
+    connections) are reused between runs with the same [api] settings, so
+    frequent cron jobs only pay for the work itself:
+
+    openphoto-serve &
+    openphoto-serve --call importer -- -r -C -c /srv/photos
+
+    Runs happen one at a time, and their output goes to the server log.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+from . import instrument
+from .cli import TOOLS
+from .main import run
+
+__all__ = ["Server", "call", "serve"]
+log = logging.getLogger(__name__)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # a probe from serve() checking for a running server
+
+        try:
+            request = json.loads(line.decode("utf-8"))
+            rc = self.server.run(request["tool"], request.get("argv", []),
+                                 request.get("cwd"))
+        except (KeyError, ValueError) as e:
+            log.error("Bad request: %s", e)
+            rc = 2
+        self.wfile.write((json.dumps({"rc": rc}) + "\n").encode("utf-8"))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def run(self, tool, argv, cwd=None):
+        parse = TOOLS[tool]
+        with self._lock:
+            if cwd:
+                os.chdir(cwd)
+            try:
+                config, fun, args, kwargs = parse(argv)
+            except SystemExit as e:
+                # argparse already printed the error (or the help)
+                return e.code if isinstance(e.code, int) else 2
+
+            self.warm(config)
+            instrument.reset()
+            log.info("Running %s %s", tool, " ".join(argv))
+            rc = run(fun, config, *args, **kwargs)
+            log.info("%s finished with status %s", tool, rc)
+            return rc
+
+    def warm(self, config):
+        """ Reuse the client built for the same [api] settings """
+        key = tuple(sorted((k, str(v)) for k, v in config.api.items()))
+        if key in self.clients:
+            config.client, config.session = self.clients[key]
+        else:
+            self.clients[key] = (config.client, config.session)
+
+
+def serve(path):
+    if os.path.exists(path):
+        # a stale socket from a previous server, unless one is still there
+        try:
+            call_socket(path).close()
+            log.error("A server is already listening on %s", path)
+            return 1
+        except socket.error:
+            os.unlink(path)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    server = Server(path)
+    log.info("Listening on %s", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Terminated.")
+    finally:
+        server.server_close()
+        os.unlink(path)
+    return 0
+
+
+def call_socket(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+def call(path, tool, argv):
+    """ Run a tool on the server listening on path and return its status """
+    try:
+        sock = call_socket(path)
+    except socket.error as e:
+        log.error("Cannot connect to %s: %s", path, e)
+        return 2
+
+    try:
+        request = dict(tool=tool, argv=list(argv), cwd=os.getcwd())
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        reply = sock.makefile("rb").readline()
+    finally:
+        sock.close()
+
+    try:
+        return json.loads(reply.decode("utf-8"))["rc"]
+    except (KeyError, ValueError):
+        log.error("The server closed the connection")
+        return 2
@@ -1,42 +1,184 @@
 #!/usr/bin/env python
 
-import argparse
+import hashlib
 import logging
 import os
 import shutil
+import threading
+import time
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
 from openphoto import (Album,
                        Photo,
                        Tag)
-from .config import Config
-from .main import run
+from . import (cli,
+               instrument)
+from .hashing import (hash_file,
+                      new)
+from .layout import Layout
+from .paging import iter_photos
+from .store import (FileIndex,
+                    SyncState)
+from .workers import (HostLimiter,
+                      Pending,
+                      WorkerPool)
 
 log = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Download photos from openphoto/trovebox")
-    config = Config("downloader", parser)
-    config.add_argument("-d", "--photo-directory", help="Photo directory", required=True)
-    config.add_argument("-c", "--photo-cache-directory",
-                        help="Search for photo in this directory before downloading")
-    config.parse_args()
-    if config.downloader.photo_cache_directory:
-        cache = os.path.realpath(config.downloader.photo_cache_directory)
+class TransferStats(object):
+
+    def __init__(self):
+        self.photos = 0
+        self.bytes = 0
+        self.errors = 0
+        self.verified = 0
+        self.corrupted = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        instrument.incr("download.photos")
+        instrument.incr("download.bytes", size)
+        with self._lock:
+            self.photos += 1
+            self.bytes += size
+
+    def error(self):
+        instrument.incr("download.errors")
+        with self._lock:
+            self.errors += 1
+
+    def verify(self, ok):
+        with self._lock:
+            self.verified += 1
+            if not ok:
+                self.corrupted += 1
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        mb = self.bytes / (1024.0 * 1024.0)
+        res = ("Downloaded %d photos (%.1f MB, %d errors) in %.1fs: "
+               "%.2f photos/s, %.2f MB/s" % (self.photos, mb, self.errors,
+                                             elapsed, self.photos / elapsed,
+                                             mb / elapsed))
+        if self.verified:
+            res += "; verified %d photos, %d corrupted" % (self.verified,
+                                                          self.corrupted)
+        return res
+
+
+def photo_host(photo, default=None):
+    url = getattr(photo, "path_original", None)
+    if not url:
+        return default
+    return urlparse(url).netloc or default
+
+
+def fetch(session, url, path):
+    """ Download url to path, resuming from what is already in path.
+        Return the hash of the whole file, computed while writing it.
+    """
+    offset = os.path.getsize(path) if os.path.isfile(path) else 0
+    headers = {"Range": "bytes=%d-" % offset} if offset else {}
+    response = session.get(url, headers=headers, stream=True)
+    if offset and response.status_code == 416:
+        # nothing left to fetch
+        return hash_file(path)
+    response.raise_for_status()
+
+    digest = new()
+    if offset and response.status_code == 206:
+        mode = "ab"
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
     else:
-        cache = None
+        mode = "wb"
+
+    with open(path, mode) as f:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def download_photo(photo, photo_path, semaphore, stats, session,
+                   client=None):
+    """ Download into a .part file, check its hash and move it in place.
+        With client, a listed photo is first made downloadable.
+    """
+    print("Downloading photo %s" % (photo.id))
+    part = photo_path + ".part"
+    try:
+        if client is not None:
+            photo = downloadable(client, photo)
+        with semaphore:
+            url = getattr(photo, "path_original", None)
+            if url:
+                digest = fetch(session, url, part)
+            else:
+                photo.download(part)
+                digest = None
 
-    return run(download_photos, config,
-               os.path.realpath(config.downloader.photo_directory),
-               cache)
+        if photo.hash and digest is None:
+            digest = instrument.timed("hash", hash_file, part)
+        if photo.hash and digest != photo.hash:
+            os.unlink(part)
+            raise IOError("hash mismatch")
 
+        os.rename(part, photo_path)
+        instrument.incr("fs.rename")
+        stats.add(os.path.getsize(photo_path))
 
-def populate_cache(directory):
-    # TODO
-    return {}
+    except Exception as e:
+        stats.error()
+        print ("Error downloading photo %s: %s" % (photo.id, e))
 
 
-def download_photos(config, destination, cache=None):
+def verify_photo(photo, photo_path, semaphore, stats, session, client=None):
+    ok = not photo.hash or \
+        instrument.timed("hash", hash_file, photo_path, True) == photo.hash
+    stats.verify(ok)
+    if not ok:
+        print("Photo %s is corrupted" % (photo.id))
+        os.unlink(photo_path)
+        download_photo(photo, photo_path, semaphore, stats, session, client)
 
+
+def populate_cache(directory, index_path):
+    return FileIndex(index_path).update(directory)
+
+
+def link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+        instrument.incr("fs.link")
+    except OSError:
+        # cross-device link or no hardlink support
+        shutil.copy2(source, dest)
+        instrument.incr("fs.copy")
+
+
+def shard_of(photo_id, count):
+    """ The shard (0 based) of a photo, the same on every machine """
+    digest = hashlib.md5(str(photo_id).encode("utf-8")).hexdigest()
+    return int(digest, 16) % count
+
+
+def download_photos(config, destination, cache=None, jobs=1,
+                    jobs_per_host=4, incremental=False, verify=False,
+                    link_jobs=4, link_mode="hardlink", date_folders=False,
+                    shard=None, merge=False):
+    """ Mirror the photos in destination/.photos and link them in albums
+        and tags.
+        With shard=(i, n) only the i-th of n disjoint subsets of the photos
+        (1 based) is downloaded and no links are made; once every shard is
+        done, merge=True builds the links without downloading anything.
+    """
     client = config.client
     if not os.path.isdir(destination):
         raise OSError("No such directory '%s'" % (destination))
@@ -47,63 +189,207 @@ def download_photos(config, destination, cache=None):
     except OSError:
         pass
 
+    state = None
+    if incremental:
+        name = ".sync.sqlite"
+        if shard:
+            name = ".sync.shard-%d-of-%d.sqlite" % shard
+        state = SyncState(os.path.join(destination, name))
+
+    dated = []
+    if merge:
+        if date_folders:
+            dated = [(photo.id, photo_ext(photo), photo_taken(photo))
+                     for photo in iter_photos(client)]
+    else:
+        mirror_photos(config, photo_dir, state, cache, jobs, jobs_per_host,
+                      verify, shard, dated if date_folders else None)
+
+    if shard:
+        log.info("Shard %d of %d done, links are made by --merge", *shard)
+    else:
+        link_photos(client, destination, photo_dir, state, link_jobs,
+                    link_mode, dated if merge or not state else None,
+                    date_folders)
+
+    if state:
+        state.set_meta("last_sync", str(time.time()))
+        state.close()
+
+
+def mirror_photos(config, photo_dir, state, cache, jobs, jobs_per_host,
+                  verify, shard=None, dated=None):
+    client = config.client
     if cache:
-        cache = populate_cache(cache)
+        cache = populate_cache(cache, os.path.join(config.default_dir,
+                                                   "photo_cache.sqlite"))
     else:
         cache = {}
 
-    for photo in Photo.all(client):
-        if photo.hash in cache:
-            shutil.copy(cache[photo.hash], destination)
-        else:
-            print("Downloading photo %s" % (photo.id))
+    stats = TransferStats()
+    limiter = HostLimiter(jobs_per_host)
+    session = config.session
+    with WorkerPool(jobs, name="download") as pool:
+        for photo in list_photos(client, state):
+            if shard and shard_of(photo.id, shard[1]) != shard[0] - 1:
+                continue
+
+            if state:
+                state.add_photo(photo.id, photo.hash, photo_ext(photo),
+                                photo_taken(photo))
+            elif dated is not None:
+                dated.append((photo.id, photo_ext(photo), photo_taken(photo)))
+
             photo_path = os.path.join(photo_dir, photo.id)
+            semaphore = limiter.get(photo_host(photo, config.api.host))
             if os.path.isfile(photo_path):
+                if verify:
+                    pool.submit(verify_photo, photo, photo_path, semaphore,
+                                stats, session, client)
                 continue
-            try:
-                photo.download(photo_path)
-            except Exception as e:
-                print ("Error downloading photo %s: %s" % (photo.id, e))
-
-    for album in Album.all(client):
-        album_dir = os.path.join(destination, album.name)
-        print("Creating links for album %s" % (album.name))
-        try:
-            os.mkdir(album_dir)
-        except OSError:
-            pass
-
-        for photo in album.photos():
-            photo_path = os.path.join(photo_dir, photo.id)
-            if not os.path.isfile(photo_path):
+
+            if photo.hash in cache:
+                instrument.incr("photo_cache.hits")
+                link_or_copy(cache[photo.hash], photo_path)
                 continue
-            ext = os.path.splitext(photo.filename_original)[-1].lower()
-            dest = os.path.join(album_dir, "%s%s" % (photo.id, ext))
-            if not os.path.exists(dest):
-                os.link(photo_path, dest)
 
-    tags_dir = os.path.join(destination, "tags")
+            pool.submit(download_photo, photo, photo_path, semaphore, stats,
+                        session, client)
+
+    log.info("%s", stats)
+    if state:
+        # only trust the state for early stops if nothing went wrong
+        state.set_meta("photos_complete", "0" if stats.errors else "1")
+    return stats
+
+
+def link_photos(client, destination, photo_dir, state, link_jobs=4,
+                link_mode="hardlink", dated=None, date_folders=False):
+    """ Lay out albums, tags and date folders of the mirrored photos.
+        Dates come from dated, or from the state when it's None.
+    """
+    # fetch memberships concurrently, then lay out all the links at once
+    start = time.time()
+    layout = Layout(destination, photo_dir, link_mode)
+    plans = []
+    with WorkerPool(link_jobs, name="members") as pool:
+        for album in Album.all(client):
+            plans.append(plan_collection(pool, "album", album.name, album,
+                                         album.name, state))
+
+        for tag in Tag.all(client):
+            plans.append(plan_collection(pool, "tag", tag.id, tag,
+                                         os.path.join("tags", tag.id),
+                                         state))
+
+    for plan in plans:
+        layout_collection(layout, photo_dir, state, *plan)
+
+    if date_folders:
+        for id_, ext, taken in (state.photos() if dated is None else dated):
+            if taken:
+                layout.add(os.path.join(
+                    "dates", time.strftime("%Y/%m", time.gmtime(taken)),
+                    "%s%s" % (id_, ext or "")), id_)
+
+    layout.apply()
+    log.info("Laid out %d albums and tags in %.1fs", len(plans),
+             time.time() - start)
+
+
+def list_photos(client, state=None):
+    """ Iterate over remote photos.
+        With a complete sync state photos are listed newest first and
+        the listing stops at the first photo which was already mirrored.
+    """
+    if not state or state.get_meta("photos_complete") != "1":
+        if state:
+            state.set_meta("photos_complete", "0")
+        for photo in iter_photos(client):
+            yield photo
+        return
+
+    state.set_meta("photos_complete", "0")
+    for photo in iter_photos(client, sortBy="dateUploaded,desc"):
+        if state.has_photo(photo.id, photo.hash):
+            log.info("Photo %s already synced, stopping", photo.id)
+            return
+        yield photo
+
+
+def downloadable(client, photo):
+    """ Listed photos are compact records; without a download URL the full
+        photo is needed for Photo.download.
+        Called by the workers, only for the photos they download.
+    """
+    if photo.path_original:
+        return photo
+    return Photo.get(client, photo.id)
+
+
+def collection_signature(collection):
+    count = getattr(collection, "count", None)
+    if count is None:
+        return None
+    return "%s:%s" % (count, getattr(collection, "date_last_photo_added", ""))
+
+
+def photo_ext(photo):
+    return os.path.splitext(photo.filename_original)[-1].lower()
+
+
+def photo_taken(photo):
     try:
-        os.mkdir(tags_dir)
-    except OSError:
-        pass
+        return float(getattr(photo, "date_taken", None))
+    except (TypeError, ValueError):
+        return None
 
-    for tag in Tag.all(client):
-        tag_dir = os.path.join(tags_dir, tag.id)
-        print("Creating links for tag %s" % (tag.id))
-        try:
-            os.mkdir(tag_dir)
-        except OSError:
-            pass
 
-        for photo in tag.photos():
-            photo_path = os.path.join(photo_dir, photo.id)
-            if not os.path.isfile(photo_path):
-                continue
-            ext = os.path.splitext(photo.filename_original)[-1]
-            dest = os.path.join(tag_dir, "%s%s" % (photo.id, ext))
-            if not os.path.exists(dest):
-                os.link(photo_path, dest)
+def fetch_members(collection):
+    instrument.incr("api.memberships")
+    return dict((photo.id, photo_ext(photo))
+                for photo in collection.photos())
+
+
+def plan_collection(pool, kind, name, collection, reldir, state=None):
+    signature = collection_signature(collection)
+    if state and signature and state.signature(kind, name) == signature:
+        log.debug("%s %s unchanged, using stored photos", kind, name)
+        members = Pending.resolved(state.members(kind, name))
+        return kind, name, reldir, signature, members, False
+
+    members = Pending()
+    pool.submit(members.run, fetch_members, collection)
+    return kind, name, reldir, signature, members, True
+
+
+def layout_collection(layout, photo_dir, state, kind, name, reldir,
+                      signature, members, changed):
+    try:
+        members = members.get()
+    except Exception as e:
+        print("Error getting photos for %s %s: %s" % (kind, name, e))
+        layout.keep(reldir)
+        return
+
+    if changed:
+        print("Creating links for %s %s" % (kind, name))
+
+    complete = True
+    for id_, ext in list(members.items()):
+        if not os.path.isfile(os.path.join(photo_dir, id_)):
+            complete = False
+            del members[id_]
+            continue
+        layout.add(os.path.join(reldir, "%s%s" % (id_, ext)), id_)
+
+    if state and changed:
+        state.set_members(kind, name, members,
+                          signature if complete else None)
+
+
+def main(argv=None):
+    return cli.downloader(argv)
 
 
 if __name__ == '__main__':
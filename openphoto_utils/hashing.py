@@ -0,0 +1,52 @@
+""" Hash files with bounded memory, and keep the page cache for the files
+    which are about to be read again.
+    Digests are the sha1 of the content, as computed by the server and by
+    openphoto.utils.hash_.
+"""
+import hashlib
+import os
+
+__all__ = ["CHUNK_SIZE", "forget", "hash_file", "new"]
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def new():
+    return hashlib.sha1()
+
+
+def advise(fd, advice):
+    """ posix_fadvise the whole file where supported """
+    advice = getattr(os, advice, None)
+    if advice is not None and hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+
+def hash_file(path, drop=False, chunk_size=CHUNK_SIZE):
+    """ Hash path reading chunk_size bytes at a time.
+        With drop the file is evicted from the page cache afterwards, for
+        files which won't be read again soon.
+    """
+    digest = new()
+    with open(path, "rb") as f:
+        advise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+        if drop:
+            advise(f.fileno(), "POSIX_FADV_DONTNEED")
+    return digest.hexdigest()
+
+
+def forget(path):
+    """ Drop path from the page cache once it's not needed anymore """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        advise(fd, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
@@ -1,222 +1,598 @@
 #!/usr/bin/env python
 
-import argparse
-from requests.exceptions import HTTPError
+from collections import namedtuple
+from requests.exceptions import (HTTPError,
+                                 RequestException)
+import json
 import logging
 import os
+import threading
 try:
     import cPickle as pickle
 except:
     import pickle
 from openphoto import (Album,
                        Photo)
-from openphoto.utils import hash_
-from .config import Config
-from .main import run
+from . import (cli,
+               instrument)
+from .hashing import (forget,
+                      hash_file)
+from .paging import iter_photos
+from .scanner import (Scanner,
+                      ScanPosition,
+                      is_video)
+from .store import (HashCache,
+                    HashStore,
+                    Journal)
+from .watcher import Watcher
+from .workers import (Pending,
+                      Sequencer,
+                      WorkerPool)
 
 log = logging.getLogger(__name__)
 
+# the fields of a remote album the importer uses, without the full Album
+# object and the client it holds
+RemoteAlbum = namedtuple("RemoteAlbum", "id name")
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Import photos to openphoto/trovebox")
-    config = Config("importer", parser)
-    config.add_argument("target", help="Directory or file to upload",
-                        required=True, nargs="+")
-    config.add_argument("-a", "--album", help="Create album(s)")
-    config.add_argument("-r", "--recurse", help="Recurse into subdirectories",
-                        action="store_true", default=False)
-    config.add_argument("-C", "--create-albums", action="store_true",
-                        help="Create albums from directories", default=False)
-    config.add_argument("-c", "--hashes", action="store_true",
-                        help="Compare hashes before uploading", default=False)
-    config.add_argument("--refresh-hashes", action="store_true",
-                        default=False, help="Refresh hashes from remote")
-    config.add_argument("-t", "--tag", action="append",
-                        help="Add tags to photos (can be \
-                        specified multiple times)")
-    config.add_argument("-R", "--remove-tag", action="append",
-                        help="Remove tags from photos (can be \
-                        specified multiple times)")
-    config.add_argument("--public", action="store_true",
-                        default=False, help="Make photos public")
-    config.add_argument(
-        '--skip-update-if-hashed', "-U", action="store_true",
-        default=False,
-        help="Do not update metadata if photo is found in hashes")
-    config.parse_args()
-
-    if config.importer.album and config.importer.create_albums:
-        parser.error("Conflicting options --album and --create-albums")
-
-    if not all(os.path.isdir(t) for t in config.importer.target) and \
-       not all(os.path.isfile(t) for t in config.importer.target):
-        parser.error("Cannot mix files and directories")
-
-    if os.path.isdir(config.importer.target[0]):
-        func = import_directories
-        if len(config.importer.target) > 1:
-            if config.importer.album:
-                parser.error("Cannot set --album with multiple target dirs")
-        if config.importer.recurse and not config.importer.create_albums:
-            log.warn("--recurse enables --create-albums")
 
+def main(argv=None):
+    return cli.importer(argv)
+
+
+def init_hashes(config):
+    hashes = HashStore(os.path.join(config.default_dir,
+                                    "photos.hashes.sqlite"))
+    if config.importer.rebuild_hashes:
+        hashes.clear()
+
+    if hashes.get_meta("complete") == "1":
+        if config.importer.refresh_hashes:
+            log.info("Refreshing remote hashes")
+            fetch_hashes(config, hashes, incremental=True)
+        else:
+            log.info("Using stored hashes")
+        return hashes
+
+    if not migrate_hashes(config, hashes):
+        log.info("Getting remote hashes")
+        fetch_hashes(config, hashes)
+
+    hashes.set_meta("complete", "1")
+    return hashes
+
+
+def uploaded_at(photo):
+    try:
+        return float(getattr(photo, "date_uploaded", 0) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def fetch_hashes(config, hashes, incremental=False):
+    """ Stream remote photos into the hash store.
+        When incremental, photos are listed newest first and only the
+        ones uploaded since the last recorded sync point are fetched.
+    """
+    last = float(hashes.get_meta("last_uploaded", 0))
+    if incremental:
+        photos = iter_photos(config.client, sortBy="dateUploaded,desc")
     else:
-        func = import_files
+        photos = iter_photos(config.client)
 
-    return run(func, config, config.importer.target,
-               album=config.importer.album,
-               recurse=config.importer.recurse,
-               create_albums=config.importer.create_albums,
-               compare_hash=config.importer.hashes,
-               tags=config.importer.tag, public=config.importer.public,
-               remove_tags=config.importer.remove_tag,
-               skip_update_if_hashed=config.importer
-               .skip_update_if_hashed)
+    newest = last
+    count = 0
+    for photo in photos:
+        uploaded = uploaded_at(photo)
+        if incremental:
+            if uploaded and uploaded < last:
+                break
+            if not uploaded and photo.hash in hashes:
+                break
 
+        hashes.add(photo)
+        newest = max(newest, uploaded)
+        count += 1
 
-def init_hashes(config):
+    hashes.commit()
+    hashes.set_meta("last_uploaded", repr(newest))
+    log.info("Fetched %d remote hashes", count)
+
+
+def migrate_hashes(config, hashes):
+    """ Import the hashes pickled by older versions """
     hfile = os.path.join(config.default_dir,
                          "photos.hashes.cache")
-    if config.importer.refresh_hashes:
-        try:
-            os.unlink(hfile)
+    if not os.path.isfile(hfile):
+        return False
 
-        except:
-            pass
     try:
-        with open(hfile) as f:
-            hashes = pickle.load(f)
-        log.info("Using stored hashes")
+        with open(hfile, "rb") as f:
+            photos = pickle.load(f)
 
-    except:
-        log.exception('Error getting stored hashes')
-        log.info("Getting remote hashes")
-        hashes = {p.hash: p for p in Photo.all(config.client)}
+    except Exception:
+        log.exception("Error reading stored hashes from %s", hfile)
+        return False
 
-    return hashes
+    log.info("Migrating hashes from %s", hfile)
+    for photo in photos.values():
+        hashes.add(photo)
+    hashes.commit()
+    hashes.set_meta("last_uploaded",
+                    repr(max([uploaded_at(p) for p in photos.values()] or
+                             [0.0])))
+    os.unlink(hfile)
+    return True
+
+
+def init_journal(config):
+    return Journal(os.path.join(config.default_dir, "import.journal.sqlite"))
 
 
-def write_hashes(config, hashes):
-    if not hashes:
+def init_hash_cache(config, rehash=False):
+    return HashCache(os.path.join(config.default_dir, "files.hashes.sqlite"),
+                     rehash=rehash)
+
+
+def write_hashes(config, hashes, hash_cache=None):
+    if hash_cache is not None:
+        log.info("Local hash cache: %d hits, %d misses",
+                 hash_cache.hits, hash_cache.misses)
+        hash_cache.close()
+
+    if hashes is None:
         return
 
-    hfile = os.path.join(config.default_dir,
-                         "photos.hashes.cache")
-    log.info("Writing hashes to %s", hfile)
+    log.info("Writing hashes to %s", hashes.path)
+    hashes.close()
+
 
-    with open(hfile, "wb") as f:
-        pickle.dump(hashes, f)
+def is_importable(target):
+    return not is_video(target)
+
+
+class AlbumCache(object):
+    """ name -> RemoteAlbum map of the remote albums.
+        Albums are listed once, stored across runs (as JSON only readable
+        by the user) and only created when missing; a conflict from the
+        server reloads the list.
+    """
+
+    def __init__(self, client, path=None, refresh=False):
+        self.client = client
+        self.path = path
+        self.albums = None
+        self.dirty = False
+        if path and not refresh:
+            self.albums = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                albums = dict((name, RemoteAlbum(id_, name))
+                              for name, id_ in json.load(f).items())
+            log.info("Using stored albums")
+            return albums
+
+        except Exception:
+            return None
+
+    def fetch(self):
+        log.info("Getting remote albums")
+        instrument.incr("api.album_list")
+        self.albums = dict((a.name, RemoteAlbum(a.id, a.name))
+                           for a in Album.all(self.client))
+        self.dirty = True
+
+    def get(self, name):
+        if self.albums is None:
+            self.fetch()
+
+        try:
+            return self.albums[name]
+        except KeyError:
+            pass
+
+        instrument.incr("api.album_create")
+        try:
+            album = Album.create(self.client, name=name, return_existing=True)
+
+        except HTTPError as e:
+            if e.response.status_code != 409:
+                raise
+            log.info("Album %s already exists, reloading albums", name)
+            self.fetch()
+            return self.albums[name]
+
+        album = self.albums[name] = RemoteAlbum(album.id, album.name)
+        self.dirty = True
+        return album
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+
+        tmp = self.path + ".tmp"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict((name, album.id)
+                           for name, album in self.albums.items()), f)
+        os.rename(tmp, self.path)
+        self.dirty = False
+
+
+def init_albums(config):
+    # older versions pickled the albums along with the client credentials
+    old = os.path.join(config.default_dir, "albums.cache")
+    if os.path.isfile(old):
+        log.info("Removing the old album cache %s", old)
+        os.unlink(old)
+    return AlbumCache(config.client,
+                      os.path.join(config.default_dir, "albums.json"),
+                      refresh=config.importer.refresh_albums)
+
+
+class UpdateBatcher(object):
+    """ Collect metadata updates of already uploaded photos and send them
+        through the bulk update endpoint: one request per batch of photos
+        sharing the same tags, albums and privacy, adding and removing
+        tags at once.
+        The files of a batch are recorded in journal, and on_done(token) is
+        called for them, once it is sent.
+    """
+
+    def __init__(self, client, batch_size=50, journal=None, on_done=None):
+        self.client = client
+        self.batch_size = max(1, int(batch_size))
+        self.journal = journal
+        self.on_done = on_done
+        self.batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, photo, tags=None, remove_tags=None, private=True,
+            albums=None, path=None, token=None):
+        key = (tuple(tags or ()), tuple(remove_tags or ()), private,
+               albums.id if albums else None)
+        with self._lock:
+            items = self.batches.setdefault(key, [])
+            items.append((photo.id, path, albums.name if albums else None,
+                          token))
+            if len(items) < self.batch_size:
+                return
+            del self.batches[key]
+        self.send(key, items)
+
+    def flush(self):
+        with self._lock:
+            batches, self.batches = self.batches, {}
+        for key, items in batches.items():
+            self.send(key, items)
+
+    def send(self, key, items):
+        tags, remove_tags, private, album = key
+        ids = [item[0] for item in items]
+        params = {"ids": ",".join(ids), "permission": 0 if private else 1}
+        if tags:
+            params["tagsAdd"] = ",".join(tags)
+        if remove_tags:
+            params["tagsRemove"] = ",".join(remove_tags)
+        if album:
+            params["albumsAdd"] = album
+
+        log.info("Updating %d photos", len(ids))
+        instrument.incr("api.update")
+        status, reason = "updated", None
+        try:
+            self.client.post("/photos/update.json", **params)
+        except RequestException as e:
+            status, reason = "failed", str(e) or type(e).__name__
+            instrument.incr("update.errors")
+            log.critical("Error while updating photos %s: %s",
+                         params["ids"], reason)
+
+        for id_, path, album_name, token in items:
+            if self.journal is not None and path is not None:
+                self.journal.record(path, status, album_name, reason)
+            if self.on_done:
+                self.on_done(token)
 
 
 def import_photo(config, target, albums=None, hashes=None,
                  raise_errors=False, tags=None, public=False,
-                 remove_tags=None, skip_update_if_hashed=False):
-    t = target.lower()
-    if "mp4" in t or "avi" in t:
+                 remove_tags=None, skip_update_if_hashed=False,
+                 photo_hash=None, updates=None, turn=None, token=None):
+    if not is_importable(target):
         return None
 
     photo = None
     private = not public
-    if hashes:
-        photo = hashes.get(hash_(target))
+    # the API takes album ids, the cache only holds RemoteAlbum records
+    album_id = albums.id if albums else None
+    if hashes is not None:
+        photo = hashes.get(photo_hash or hash_file(target))
         if photo:
             if skip_update_if_hashed:
                 log.info("%s hash found, skipping upload/update", target)
                 return photo
 
             log.info("%s hash found, skipping upload, updating info", target)
+            if updates is not None:
+                updates.add(photo, tags=tags, remove_tags=remove_tags,
+                            private=private, albums=albums, path=target,
+                            token=token)
+                return photo
+
+            photo = Photo.get(config.client, photo.id)
             if remove_tags:
+                instrument.incr("api.update")
                 photo.update(tags=remove_tags, tags_action="remove")
+            instrument.incr("api.update")
             photo.update(tags=tags, tags_action="add",
-                         private=private, albums=albums)
+                         private=private, albums=album_id)
             return photo
 
+    if turn is not None:
+        # uploads to an album start in the order they were scanned
+        turn.release()
     try:
-        photo = Photo.create(config.client, target, albums=albums,
+        photo = Photo.create(config.client, target, albums=album_id,
                              tags=tags, private=private)
+        instrument.incr("upload.photos")
+        instrument.incr("upload.bytes", os.path.getsize(target))
 
     except HTTPError as e:
         if e.response.status_code == 409:
+            instrument.incr("upload.duplicates")
             log.debug("Photo hash already exists, skipping")
         else:
             if raise_errors:
                 raise e
             else:
+                instrument.incr("upload.errors")
                 log.critical("Error while uploading %s to %s",
                              target, albums)
     return photo
 
 
+def upload_photo(config, target, pending_hash, hashes, token=None,
+                 on_done=None, journal=None, **kwargs):
+    status, reason = "uploaded", None
+    try:
+        photo_hash = pending_hash.get() if pending_hash else None
+        known = hashes is not None and photo_hash in hashes
+        photo = import_photo(config, target, hashes=hashes,
+                             photo_hash=photo_hash, raise_errors=True,
+                             token=token, **kwargs)
+        if photo is None:
+            status = "skipped"
+        elif known:
+            if kwargs.get("skip_update_if_hashed"):
+                status = "skipped"
+            else:
+                status = "updated"
+        if hashes is not None and photo:
+            hashes.add(photo)
+
+    except Exception as e:
+        status, reason = "failed", str(e) or type(e).__name__
+        instrument.incr("upload.errors")
+        log.critical("Error while uploading %s to %s: %s", target,
+                     kwargs.get("albums"), reason)
+
+    finally:
+        if kwargs.get("turn") is not None:
+            kwargs["turn"].release()
+        # the hash and the upload were its last reads
+        forget(target)
+        # batched updates are recorded once their batch is sent
+        queued = status == "updated" and kwargs.get("updates") is not None
+        if not queued:
+            if journal is not None:
+                album = kwargs.get("albums")
+                journal.record(target, status,
+                               album.name if album else None, reason)
+            if on_done:
+                on_done(token)
+
+
+def import_pipeline(config, targets, hashes=None, jobs=1, hash_jobs=2,
+                    hasher=hash_file, update_batch_size=50, on_done=None,
+                    journal=None, resume=False, **kwargs):
+    """ Upload (path, album, token) tuples yielded by targets.
+        Files are hashed by a pool of hash_jobs threads while a pool of
+        jobs uploaders sends them to the server; uploads to the same album
+        start in the order they are yielded.
+        on_done(token) is called once a file has been handled, and its
+        outcome is recorded in journal; with resume, files the journal
+        already knows as done are skipped.
+    """
+    updates = UpdateBatcher(config.client, update_batch_size, journal,
+                            on_done)
+    hash_pool = WorkerPool(hash_jobs, name="hash")
+    upload_pool = WorkerPool(jobs, name="upload")
+    sequencer = Sequencer()
+    with hash_pool, upload_pool:
+        for target, album, token in targets:
+            if not is_importable(target) or \
+                    (resume and journal.is_done(target)):
+                if on_done:
+                    on_done(token)
+                continue
+
+            pending_hash = None
+            if hashes is not None:
+                pending_hash = Pending()
+                hash_pool.submit(pending_hash.run, instrument.timed, "hash",
+                                 hasher, target)
+
+            upload_pool.submit(upload_photo, config, target, pending_hash,
+                               hashes, token=token, on_done=on_done,
+                               journal=journal, albums=album,
+                               updates=updates,
+                               turn=sequencer.turn(album.id) if album
+                               else None, **kwargs)
+
+    updates.flush()
+
+
 def import_directories(config, targets, album=None, recurse=False,
                        create_albums=False, compare_hash=False,
                        tags=None, public=False, remove_tags=None,
-                       skip_update_if_hashed=False):
+                       skip_update_if_hashed=False, jobs=1, hash_jobs=2,
+                       rehash=False, update_batch_size=50, scanner=None,
+                       resume_scan=False, resume=False, retry_failed=False,
+                       watch=False, watch_debounce=5.0, watch_poll=30.0):
+    albums = init_albums(config)
     if album:
-        album = Album.create(config.client, name=album,
-                             return_existing=True)
+        album = albums.get(album)
 
     tags = tags or []
     remove_tags = remove_tags or []
 
-    hashes = None
+    hashes = hash_cache = None
     if compare_hash:
         hashes = init_hashes(config)
+        hash_cache = init_hash_cache(config, rehash)
+
+    scanner = scanner or Scanner(recurse=recurse)
+    position = ScanPosition(os.path.join(config.default_dir, "scan.position"),
+                            targets)
+    resume_target, resume_path = None, None
+    if resume_scan:
+        resume_target, resume_path = position.load()
+        if resume_target:
+            log.info("Resuming scan after %s in %s", resume_path,
+                     resume_target)
+
+    def album_of(parent):
+        album_name = os.path.basename(parent.rstrip(os.sep)).title()
+        return albums.get(album_name)
+
+    def walk(album):
+        directory = None
+        skipping = resume_target in targets
+        for target in targets:
+            start_after = None
+            if skipping:
+                if target != resume_target:
+                    continue
+                skipping = False
+                start_after = resume_path
+
+            for path, parent in scanner.scan(target, start_after):
+                if create_albums and parent != directory:
+                    directory = parent
+                    album = album_of(parent)
+                    log.info("Uploading to album %s", album)
+
+                yield path, album, position.started(target, path)
+
+    journal = init_journal(config)
+    if retry_failed:
+        roots = tuple(os.path.join(os.path.realpath(t), "") for t in targets)
+        source = failed_files(journal, albums, album, roots)
+    else:
+        source = walk(album)
+
+    options = dict(hashes=hashes, jobs=jobs, hash_jobs=hash_jobs, tags=tags,
+                   public=public, remove_tags=remove_tags,
+                   skip_update_if_hashed=skip_update_if_hashed,
+                   hasher=hash_cache.hash if hash_cache else hash_file,
+                   update_batch_size=update_batch_size, journal=journal)
+    completed = False
+    try:
+        import_pipeline(config, source,
+                        on_done=None if retry_failed else position.finished,
+                        resume=resume, **options)
+        completed = True
+        if watch:
+            position.clear()
+            watcher = Watcher(targets, scanner, watch_debounce, watch_poll)
+            for batch in watcher:
+                log.info("%d new or modified files", len(batch))
+                source = ((path, album_of(os.path.dirname(path))
+                           if create_albums else album, None)
+                          for root, path in batch)
+                import_pipeline(config, source, resume=True, **options)
+                persist(journal, albums, hashes, hash_cache)
+    finally:
+        if not retry_failed:
+            if completed:
+                position.clear()
+            else:
+                position.save()
+        finish(config, journal, albums, hashes, hash_cache)
+
 
-    for target in targets:
-        for root, dirs, files in os.walk(target):
-            if not recurse:
-                del dirs[:]
-            if create_albums:
-                album_name = os.path.basename(root[:-1]).title()
-                album = Album.create(config.client,
-                                     name=album_name,
-                                     return_existing=True)
+def failed_files(journal, albums, album, roots):
+    """ (path, album, token) of the files which failed below roots """
+    for path, album_name, reason in journal.failed():
+        if not os.path.realpath(path).startswith(roots):
+            continue
+        log.info("Retrying %s (%s)", path, reason)
+        yield path, albums.get(album_name) if album_name else album, None
 
-                log.info("Uploading to album %s", album)
 
-            for file_ in files:
-                photo = import_photo(
-                    config, os.path.join(root, file_), albums=album,
-                    hashes=hashes, tags=tags,
-                    public=public, remove_tags=remove_tags,
-                    skip_update_if_hashed=skip_update_if_hashed
-                )
-                if hashes and photo:
-                    hashes[photo.hash] = photo
+def persist(journal, albums, hashes, hash_cache):
+    """ Save what was learned so far, for long running imports """
+    journal.commit()
+    albums.save()
+    if hashes is not None:
+        hashes.commit()
+    if hash_cache is not None:
+        hash_cache.commit()
 
-    write_hashes(config, hashes)
+
+def finish(config, journal, albums, hashes, hash_cache):
+    """ Persist everything learned by an import, even an aborted one """
+    log.info("Import journal: %s", journal.summary() or "nothing done")
+    journal.close()
+    albums.save()
+    write_hashes(config, hashes, hash_cache)
 
 
 def import_files(config, targets, album=None, recurse=False,
                  create_albums=False, compare_hash=False,
                  tags=None, public=False,
-                 remove_tags=None, skip_update_if_hashed=False):
+                 remove_tags=None, skip_update_if_hashed=False,
+                 jobs=1, hash_jobs=2, rehash=False,
+                 update_batch_size=50, scanner=None, resume_scan=False,
+                 resume=False, retry_failed=False):
     if recurse:
         log.warn("recurse ignored with files")
     if create_albums:
         log.warn("create_albums ignored with files")
 
-    hashes = None
+    hashes = hash_cache = None
     if compare_hash:
         hashes = init_hashes(config)
+        hash_cache = init_hash_cache(config, rehash)
 
+    albums = init_albums(config)
     if album:
-        album = Album.create(config.client, album, True)
+        album = albums.get(album)
         log.info("Uploading to album %s", album)
 
     tags = tags or []
     remove_tags = remove_tags or []
 
-    for file_ in targets:
-        file_ = os.path.realpath(file_)
-        photo = import_photo(
-            config, file_, albums=album,
-            hashes=hashes, tags=tags,
-            public=public, remove_tags=remove_tags,
-            skip_update_if_hashed=skip_update_if_hashed
-        )
-        if hashes and photo:
-            hashes[photo.hash] = photo
-
-    write_hashes(config, hashes)
+    journal = init_journal(config)
+    scanner = scanner or Scanner()
+    files = ((os.path.realpath(file_), album, None) for file_ in targets
+             if scanner.accept(file_))
+    if retry_failed:
+        failed = set(p for p, a, r in journal.failed())
+        files = (f for f in files if f[0] in failed)
+
+    try:
+        import_pipeline(config, files, hashes=hashes, jobs=jobs,
+                        hash_jobs=hash_jobs, tags=tags, public=public,
+                        remove_tags=remove_tags,
+                        skip_update_if_hashed=skip_update_if_hashed,
+                        hasher=hash_cache.hash if hash_cache else hash_file,
+                        update_batch_size=update_batch_size,
+                        journal=journal, resume=resume)
+    finally:
+        finish(config, journal, albums, hashes, hash_cache)
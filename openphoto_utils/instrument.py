@@ -0,0 +1,131 @@
+""" Counters and timers, reported by main.run.
+    They are process-wide unless a thread binds its own Registry, as the
+    batch runner does for each account; the WorkerPool and paging threads
+    count into the registry of the thread which started them.
+"""
+from contextlib import contextmanager
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+__all__ = ["Registry", "bind", "current", "incr", "timer", "timed",
+           "snapshot", "reset", "format_summary", "format_json",
+           "format_prometheus", "write"]
+log = logging.getLogger(__name__)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+
+
+_default = Registry()
+_local = threading.local()
+
+
+def current():
+    return getattr(_local, "registry", _default)
+
+
+def bind(registry):
+    """ Count into registry in this thread, or process-wide with None """
+    _local.registry = registry or _default
+
+
+def incr(name, value=1):
+    registry = current()
+    with registry.lock:
+        registry.counters[name] = registry.counters.get(name, 0) + value
+
+
+def add_time(name, seconds):
+    registry = current()
+    with registry.lock:
+        count, total = registry.timers.get(name, (0, 0.0))
+        registry.timers[name] = (count + 1, total + seconds)
+
+
+@contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def timed(name, fun, *args, **kwargs):
+    with timer(name):
+        return fun(*args, **kwargs)
+
+
+def snapshot():
+    registry = current()
+    with registry.lock:
+        return {
+            "counters": dict(registry.counters),
+            "timers": dict((k, {"count": c, "seconds": s})
+                           for k, (c, s) in registry.timers.items()),
+        }
+
+
+def reset():
+    registry = current()
+    with registry.lock:
+        registry.counters.clear()
+        registry.timers.clear()
+
+
+def format_summary(data):
+    lines = ["Statistics:"]
+    for name, value in sorted(data["counters"].items()):
+        lines.append("  %-32s %d" % (name, value))
+    for name, t in sorted(data["timers"].items()):
+        lines.append("  %-32s %.2fs (%d)" % (name, t["seconds"], t["count"]))
+    return "\n".join(lines)
+
+
+def format_json(data):
+    return json.dumps(data, indent=2, sort_keys=True)
+
+
+def metric_name(name):
+    return "openphoto_utils_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def format_prometheus(data):
+    labels = '{tool="%s"}' % data.get("tool", "")
+    lines = []
+    for name, value in sorted(data["counters"].items()):
+        lines.append("%s_total%s %d" % (metric_name(name), labels, value))
+    for name, t in sorted(data["timers"].items()):
+        metric = metric_name(name)
+        lines.append("%s_seconds_total%s %f" % (metric, labels, t["seconds"]))
+        lines.append("%s_count%s %d" % (metric, labels, t["count"]))
+    for key in ("status", "finished"):
+        if key in data:
+            lines.append("%s_%s%s %s" % (metric_name("run"), key, labels,
+                                         data[key]))
+    return "\n".join(lines) + "\n"
+
+
+def write(path, data, format_="json"):
+    """ Write stats atomically, so textfile collectors never see a
+        partial file
+    """
+    if format_ == "prometheus":
+        text = format_prometheus(data)
+    else:
+        text = format_json(data)
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.rename(tmp, path)
+    log.debug("Wrote stats to %s", path)
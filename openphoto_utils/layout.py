@@ -0,0 +1,205 @@
+import errno
+import logging
+import os
+import shutil
+import stat
+from . import instrument
+
+__all__ = ["Layout", "MODES", "reflink"]
+log = logging.getLogger(__name__)
+
+MODES = ("hardlink", "symlink", "reflink")
+FICLONE = 0x40049409
+MANIFEST = ".layout.manifest"
+
+
+def reflink(source, dest):
+    """ Copy-on-write clone of source, or a plain copy if the
+        filesystem cannot do it
+    """
+    try:
+        import fcntl
+        with open(source, "rb") as s:
+            with open(dest, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+
+    except (ImportError, IOError, OSError) as e:
+        if getattr(e, "errno", None) not in (None, errno.EOPNOTSUPP,
+                                              errno.EXDEV, errno.EINVAL,
+                                              errno.ENOTTY):
+            raise
+
+    shutil.copyfile(source, dest)
+
+
+class Layout(object):
+    """ The tree of links to the photos in photo_dir.
+        The wanted tree is planned in memory with add(), then apply()
+        compares it to a single scan of the destination and only creates
+        and removes what differs.
+        Only files known as links to photo_dir are ever replaced or
+        removed: hardlinks and symlinks are recognized by what they point
+        to, and every link created is listed in a manifest, as reflinks
+        can't be told from other files.
+    """
+
+    def __init__(self, destination, photo_dir, mode="hardlink"):
+        if mode not in MODES:
+            raise ValueError("Unknown link mode %s" % (mode))
+        self.destination = destination
+        self.photo_dir = photo_dir
+        self.mode = mode
+        self.wanted = {}
+        self.kept = set()
+        self.manifest = os.path.join(destination, MANIFEST)
+
+    def add(self, relpath, photo_id):
+        self.wanted[relpath] = photo_id
+
+    def keep(self, reldir):
+        """ Leave the links below reldir alone, e.g. when its content
+            could not be fetched
+        """
+        self.kept.add(os.path.join(reldir, ""))
+
+    def photo_ids(self):
+        return set(name for name in os.listdir(self.photo_dir)
+                   if not name.endswith(".part"))
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest) as f:
+                return set(line.rstrip("\n") for line in f if line.strip())
+        except IOError:
+            return set()
+
+    def save_manifest(self, relpaths):
+        tmp = "%s.%d.tmp" % (self.manifest, os.getpid())
+        with open(tmp, "w") as f:
+            for relpath in sorted(relpaths):
+                f.write(relpath + "\n")
+        os.rename(tmp, self.manifest)
+
+    def is_link(self, path, source):
+        """ Whether path is a hardlink or a symlink to source """
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                return os.path.realpath(path) == os.path.realpath(source)
+            target = os.stat(source)
+            return (st.st_ino, st.st_dev) == (target.st_ino, target.st_dev)
+        except OSError:
+            return False
+
+    def scan(self, ids):
+        """ relpath -> photo id of the links already on disk """
+        existing = {}
+        manifest = self.load_manifest()
+        photo_dir = os.path.basename(self.photo_dir)
+        for root, dirs, files in os.walk(self.destination):
+            dirs[:] = [d for d in dirs
+                       if d != photo_dir and not d.startswith(".")]
+            if root == self.destination:
+                continue
+            rel = os.path.relpath(root, self.destination)
+            for name in files:
+                stem = os.path.splitext(name)[0]
+                if stem not in ids:
+                    continue
+                relpath = os.path.join(rel, name)
+                if relpath in manifest or self.is_link(
+                        os.path.join(root, name),
+                        os.path.join(self.photo_dir, stem)):
+                    existing[relpath] = stem
+        return existing
+
+    def is_current(self, source, dest):
+        try:
+            if self.mode == "symlink":
+                return os.path.islink(dest) and \
+                    os.readlink(dest) == self.link_target(source, dest)
+            if os.path.islink(dest):
+                return False
+            if self.mode == "hardlink":
+                return os.stat(dest).st_ino == os.stat(source).st_ino
+            return os.path.getsize(dest) == os.path.getsize(source)
+
+        except OSError:
+            return False
+
+    def link_target(self, source, dest):
+        return os.path.relpath(source, os.path.dirname(dest))
+
+    def create(self, source, dest):
+        if self.mode == "symlink":
+            os.symlink(self.link_target(source, dest), dest)
+        elif self.mode == "reflink":
+            reflink(source, dest)
+        else:
+            os.link(source, dest)
+        instrument.incr("fs.link")
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+            instrument.incr("fs.unlink")
+        except OSError:
+            pass
+
+    def apply(self):
+        ids = self.photo_ids()
+        existing = self.scan(ids)
+        created = removed = 0
+        touched = set()
+        linked = set()
+        for relpath, photo_id in self.wanted.items():
+            if photo_id not in ids:
+                continue
+            source = os.path.join(self.photo_dir, photo_id)
+            dest = os.path.join(self.destination, relpath)
+            if existing.get(relpath) == photo_id and \
+                    self.is_current(source, dest):
+                linked.add(relpath)
+                continue
+
+            if relpath in existing:
+                self.remove(dest)
+            elif os.path.lexists(dest):
+                log.warning("Not replacing %s: not a link to a photo", dest)
+                continue
+            directory = os.path.dirname(dest)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            try:
+                self.create(source, dest)
+                created += 1
+                linked.add(relpath)
+            except (IOError, OSError) as e:
+                log.error("Cannot link %s to %s: %s", source, dest, e)
+
+        kept = tuple(self.kept)
+        for relpath in existing:
+            if relpath in self.wanted:
+                continue
+            if relpath.startswith(kept):
+                linked.add(relpath)
+                continue
+            dest = os.path.join(self.destination, relpath)
+            self.remove(dest)
+            touched.add(os.path.dirname(dest))
+            removed += 1
+        self.save_manifest(linked)
+
+        # drop directories emptied by the removals
+        for directory in sorted(touched, reverse=True):
+            while directory != self.destination:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+        log.info("Layout: %d links wanted, %d created, %d removed",
+                 len(self.wanted), created, removed)
+        return created, removed
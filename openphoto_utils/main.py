@@ -1,11 +1,15 @@
 import logging
-from requests.exceptions import RequestException
+import time
+from . import instrument
 
 log = logging.getLogger(__name__)
 
 
 def run(fun, config,  *args, **kwargs):
 
+    from requests.exceptions import RequestException
+    rc = 2
+    start = time.time()
     try:
         fun(config, *args, **kwargs)
 
@@ -19,6 +23,25 @@ def run(fun, config,  *args, **kwargs):
         log.info("Terminated.")
 
     else:
-        return 0
+        rc = 0
 
-    return 2
+    instrument.add_time("run", time.time() - start)
+    report(config, rc)
+    return rc
+
+
+def report(config, rc):
+    stats = getattr(config, "stats", None)
+    if stats is None:
+        return
+
+    data = instrument.snapshot()
+    data.update(tool=config.app_name, status=rc, finished=int(time.time()))
+    if stats.summary:
+        print(instrument.format_summary(data))
+
+    if stats.file:
+        try:
+            instrument.write(stats.file, data, stats.format)
+        except (IOError, OSError) as e:
+            log.error("Cannot write stats to %s: %s", stats.file, e)
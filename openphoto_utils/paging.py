@@ -0,0 +1,85 @@
+import logging
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from collections import namedtuple
+from . import instrument
+
+__all__ = ["RemotePhoto", "iter_photos", "record"]
+log = logging.getLogger(__name__)
+
+# the fields of a remote photo the tools use, without the full Photo object
+RemotePhoto = namedtuple("RemotePhoto", "id hash filename_original "
+                         "path_original date_taken date_uploaded")
+
+
+def record(photo):
+    return RemotePhoto(photo.id, photo.hash,
+                       getattr(photo, "filename_original", None),
+                       getattr(photo, "path_original", None),
+                       getattr(photo, "date_taken", None),
+                       getattr(photo, "date_uploaded", None))
+
+
+class _Done(object):
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def iter_photos(client, batch_size=100, prefetch=4, **kwargs):
+    """ Iterate over Photo.all(client, **kwargs) as RemotePhoto records.
+        The listing runs in a background thread up to prefetch batches
+        ahead, so the next page is fetched while the current one is
+        consumed. Stopping early stops the listing too.
+    """
+    from openphoto import Photo
+
+    batches = queue.Queue(prefetch)
+    stop = threading.Event()
+    registry = instrument.current()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        instrument.bind(registry)
+        try:
+            batch = []
+            for photo in Photo.all(client, **kwargs):
+                batch.append(record(photo))
+                if len(batch) >= batch_size:
+                    instrument.incr("paging.records", len(batch))
+                    if not put(batch):
+                        return
+                    batch = []
+            instrument.incr("paging.records", len(batch))
+            if batch and not put(batch):
+                return
+            put(_Done())
+
+        except Exception as e:
+            put(_Done(e))
+
+    thread = threading.Thread(target=produce, name="photo-pages")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if isinstance(batch, _Done):
+                if batch.error is not None:
+                    raise batch.error
+                return
+            for photo in batch:
+                yield photo
+    finally:
+        stop.set()
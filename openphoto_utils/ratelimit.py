@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from . import instrument
+
+__all__ = ["RateLimiter", "SharedTokenBucket", "TokenBucket", "parse_rate",
+           "shared_path"]
+log = logging.getLogger(__name__)
+
+UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_rate(value):
+    """ Parse a number with an optional K/M/G suffix, e.g. 512K or 2M """
+    if value is None or value == "":
+        return None
+    match = re.match(r"^\s*([0-9.]+)\s*([kmg]?)b?\s*$", str(value), re.I)
+    if not match:
+        raise ValueError("Invalid rate %s" % (value))
+    rate = float(match.group(1)) * UNITS[match.group(2).lower()]
+    return rate or None
+
+
+def shared_path(host, directory):
+    """ The file through which every tool of this user talking to host
+        shares its budget: in $XDG_RUNTIME_DIR if set, else in directory
+    """
+    name = re.sub(r"[^a-zA-Z0-9.-]", "_", host or "default")
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        directory = os.path.join(runtime_dir, "openphoto_utils")
+    return os.path.join(directory, "%s.ratelimit" % (name))
+
+
+class TokenBucket(object):
+    """ rate tokens per second, holding at most burst.
+        A taker gets its tokens at once and sleeps off any debt, so large
+        takes (e.g. a whole upload) are allowed but slow down the next ones.
+    """
+
+    def __init__(self, name, rate, burst=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def refill(self, tokens, stamp, amount, now):
+        tokens = min(self.burst, tokens + max(0.0, now - stamp) * self.rate)
+        tokens -= amount
+        return tokens, max(0.0, -tokens / self.rate)
+
+    def reserve(self, amount):
+        """ Take amount tokens and return how long to wait for them """
+        with self._lock:
+            now = time.time()
+            self.tokens, wait = self.refill(self.tokens, self.stamp, amount,
+                                            now)
+            self.stamp = now
+            return wait
+
+    def take(self, amount=1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            instrument.incr("ratelimit.%s.waits" % (self.name))
+            instrument.add_time("ratelimit.%s" % (self.name), wait)
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """ A TokenBucket whose state lives in a small file locked with flock,
+        so several processes on the same machine draw from one budget
+    """
+
+    def __init__(self, name, rate, burst=None, path=None):
+        super(SharedTokenBucket, self).__init__(name, rate, burst)
+        self.path = path
+        self.shared = True
+
+    def open(self):
+        """ Open the state file, private to this user and never through a
+            symlink
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT |
+                     getattr(os, "O_NOFOLLOW", 0), 0o600)
+        return os.fdopen(fd, "r+")
+
+    def reserve(self, amount):
+        if not self.shared:
+            return super(SharedTokenBucket, self).reserve(amount)
+        try:
+            return self.reserve_shared(amount)
+        except (IOError, OSError) as e:
+            log.warning("Cannot share the rate limit through %s (%s), "
+                        "limiting this process only", self.path, e)
+            self.shared = False
+            return super(SharedTokenBucket, self).reserve(amount)
+
+    def reserve_shared(self, amount):
+        with self._lock:
+            with self.open() as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+
+                    now = time.time()
+                    tokens, stamp = state.get(self.name, (self.burst, now))
+                    tokens, wait = self.refill(tokens, stamp, amount, now)
+                    state[self.name] = (tokens, now)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            return wait
+
+
+class RateLimiter(object):
+    """ Limit requests per second and bytes per second of an API client.
+        With a path the budget is shared with the other processes using
+        the same file.
+    """
+
+    def __init__(self, max_rps=None, max_bandwidth=None, path=None):
+        if path and fcntl is None:
+            log.warning("Cannot share the rate limit without fcntl, "
+                        "limiting this process only")
+            path = None
+
+        self.path = path
+        self.requests = self.make_bucket("requests", max_rps,
+                                         max(1, max_rps or 1))
+        self.bandwidth = self.make_bucket("bytes", max_bandwidth)
+
+    def make_bucket(self, name, rate, burst=None):
+        if not rate:
+            return None
+        if self.path:
+            return SharedTokenBucket(name, rate, burst, self.path)
+        return TokenBucket(name, rate, burst)
+
+    def request(self, size=0):
+        """ Wait for a request slot, sending size bytes """
+        if self.requests:
+            self.requests.take(1)
+        self.transfer(size)
+
+    def transfer(self, size):
+        if self.bandwidth and size:
+            self.bandwidth.take(size)
+
+    def __repr__(self):
+        return "<RateLimiter rps: %s, bandwidth: %s, shared: %s>" % (
+            self.requests.rate if self.requests else None,
+            self.bandwidth.rate if self.bandwidth else None, self.path)
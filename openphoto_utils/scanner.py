@@ -0,0 +1,214 @@
+from collections import OrderedDict
+import fnmatch
+import json
+import logging
+import os
+import threading
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+__all__ = ["Scanner", "ScanPosition", "is_video", "sniff"]
+log = logging.getLogger(__name__)
+
+MAGIC = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"BM", "bmp"),
+)
+
+
+def is_video(path):
+    t = os.path.basename(path).lower()
+    return "mp4" in t or "avi" in t
+
+
+def sniff(path):
+    """ Return the image type of path from its first bytes, or None """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except (IOError, OSError):
+        return None
+
+    for magic, type_ in MAGIC:
+        if head.startswith(magic):
+            return type_
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def list_dir(path):
+    """ (name, is_dir) of the entries in path, sorted by name """
+    if scandir is not None:
+        entries = [(e.name, e.is_dir() and not e.is_symlink())
+                   for e in scandir(path)]
+    else:
+        entries = [(name, os.path.isdir(os.path.join(path, name)) and
+                    not os.path.islink(os.path.join(path, name)))
+                   for name in os.listdir(path)]
+    entries.sort()
+    return entries
+
+
+def split(relpath):
+    return tuple(p for p in relpath.split(os.sep) if p)
+
+
+class Scanner(object):
+    """ Stream the candidate files below a directory.
+        Entries are visited depth first in name order, so a scan can
+        restart right after the last file handled by a previous one.
+        Only one directory listing is held in memory per level.
+    """
+
+    def __init__(self, recurse=True, include=None, exclude=None,
+                 extensions=None, magic=False):
+        self.recurse = recurse
+        self.include = include or []
+        self.exclude = exclude or []
+        self.extensions = set(e.lower().lstrip(".")
+                              for e in extensions or [])
+        self.magic = magic
+
+    def matches(self, patterns, name, relpath):
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(relpath, p)
+                   for p in patterns)
+
+    def accept(self, path, relpath=None):
+        name = os.path.basename(path)
+        relpath = relpath or name
+        if is_video(name):
+            return False
+        if self.exclude and self.matches(self.exclude, name, relpath):
+            return False
+        if self.include and not self.matches(self.include, name, relpath):
+            return False
+        ext = os.path.splitext(name)[1].lower().lstrip(".")
+        if self.extensions and ext not in self.extensions:
+            return False
+        if self.magic and not sniff(path):
+            return False
+        return True
+
+    def scan(self, root, start_after=None):
+        """ Yield (path, directory) for the accepted files below root,
+            skipping everything up to the relative path start_after
+        """
+        after = split(start_after) if start_after else None
+        stack = [((), self.list(root))]
+        while stack:
+            parts, entries = stack[-1]
+            try:
+                name, is_dir = next(entries)
+            except StopIteration:
+                stack.pop()
+                continue
+
+            current = parts + (name, )
+            relpath = os.path.join(*current)
+            path = os.path.join(root, relpath)
+            if is_dir:
+                if not self.recurse:
+                    continue
+                if self.exclude and self.matches(self.exclude, name, relpath):
+                    continue
+                if after and current < after[:len(current)]:
+                    continue
+                stack.append((current, self.list(path)))
+                continue
+
+            if after and current <= after:
+                continue
+            if self.accept(path, relpath):
+                yield path, os.path.dirname(path)
+
+    def list(self, directory):
+        try:
+            return iter(list_dir(directory))
+        except OSError as e:
+            log.error("Cannot list %s: %s", directory, e)
+            return iter(())
+
+
+class ScanPosition(object):
+    """ Remember how far a scan got.
+        The position only moves past a file once it and every file before
+        it are finished, so files still in flight are scanned again.
+    """
+    save_every = 100
+
+    def __init__(self, path, targets):
+        self.path = path
+        self.targets = list(targets)
+        self.pending = OrderedDict()
+        self.position = None
+        self.seq = 0
+        self.advanced = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Return (target, relpath) where the last scan stopped """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, None
+
+        if data.get("targets") != self.targets:
+            log.info("Scan position is for other targets, ignoring")
+            return None, None
+        return data["target"], data["relpath"]
+
+    def started(self, target, path):
+        with self._lock:
+            self.seq += 1
+            relpath = os.path.relpath(path, target)
+            self.pending[self.seq] = [(target, relpath), False]
+            return self.seq
+
+    def finished(self, token):
+        with self._lock:
+            self.pending[token][1] = True
+            moved = False
+            while self.pending:
+                key = next(iter(self.pending))
+                position, done = self.pending[key]
+                if not done:
+                    break
+                self.position = position
+                del self.pending[key]
+                moved = True
+            if moved:
+                self.advanced += 1
+                if self.advanced % self.save_every == 0:
+                    self._save()
+
+    def _save(self):
+        if self.position is None:
+            return
+        target, relpath = self.position
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(targets=self.targets, target=target,
+                           relpath=relpath), f)
+        os.rename(tmp, self.path)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -1,36 +1,28 @@
 #!/usr/bin/env python
 
-import argparse
 import logging
 import sys
 from openphoto import (Album,
                        Photo,
                        Tag)
-from .config import Config
+from . import cli
+from .cli import SHELLS
 
 log = logging.getLogger(__name__)
-SHELLS = ("ipython", "bpython", "default", "auto")
 
 
 class ShellNotFound(Exception):
     pass
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Drop a shell with a configured client"
-    )
-    config = Config("shell", parser)
-    config.add_argument("--shell", help="Shell to use (defaults to auto)",
-                        choices=SHELLS, default="auto")
-
-    config.parse_args()
-    return select_shell(config, config.shell.shell)
+def main(argv=None):
+    return cli.shell(argv)
 
 
 def get_env(config):
     env = dict(
         client=(config.client, "Openphoto raw client"),
+        session=(config.session, "Pooled HTTP session"),
         config=(config, "Config object"),
         Album=(Album, "Album class"),
         Photo=(Photo, "Photo class"),
@@ -0,0 +1,411 @@
+from collections import namedtuple
+import logging
+import os
+import sqlite3
+import threading
+import time
+from .hashing import hash_file
+from . import instrument
+
+__all__ = ["connect", "FileIndex", "SyncState", "HashStore", "PhotoRecord",
+           "HashCache", "Journal"]
+log = logging.getLogger(__name__)
+
+
+def connect(path, **kwargs):
+    """ Open (creating it if needed) a sqlite database """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    db = sqlite3.connect(path, **kwargs)
+    # allow 8-bit bytestrings paths on python 2
+    db.text_factory = str
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class FileIndex(object):
+    """ Persistent hash -> path index of the files in a directory.
+        Files are only rehashed when their size or mtime change.
+    """
+    commit_every = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "path TEXT PRIMARY KEY, size INTEGER, "
+                        "mtime REAL, hash TEXT, scan INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_hash "
+                        "ON files (hash)")
+        self.db.commit()
+
+    def update(self, directory):
+        scan = (self.db.execute("SELECT MAX(scan) FROM files")
+                .fetchone()[0] or 0) + 1
+        hashed = seen = 0
+        for root, dirs, files in os.walk(directory):
+            for file_ in files:
+                path = os.path.join(root, file_)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                seen += 1
+                row = self.db.execute("SELECT size, mtime FROM files "
+                                      "WHERE path = ?", (path, )).fetchone()
+                if row and row[0] == st.st_size and row[1] == st.st_mtime:
+                    self.db.execute("UPDATE files SET scan = ? "
+                                    "WHERE path = ?", (scan, path))
+                else:
+                    hashed += 1
+                    self.db.execute("INSERT OR REPLACE INTO files "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    (path, st.st_size, st.st_mtime,
+                                     instrument.timed("hash", hash_file,
+                                                      path, True),
+                                     scan))
+
+                if seen % self.commit_every == 0:
+                    self.db.commit()
+
+        # forget files which are gone since the last scan
+        self.db.execute("DELETE FROM files WHERE scan != ?", (scan, ))
+        self.db.commit()
+        log.info("Indexed %d files in %s (%d hashed)", seen, directory,
+                 hashed)
+        return self
+
+    def get(self, hash_value, default=None):
+        row = self.db.execute("SELECT path FROM files WHERE hash = ? "
+                              "LIMIT 1", (hash_value, )).fetchone()
+        return row[0] if row else default
+
+    def __getitem__(self, hash_value):
+        path = self.get(hash_value)
+        if path is None:
+            raise KeyError(hash_value)
+        return path
+
+    def __contains__(self, hash_value):
+        return self.get(hash_value) is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+class SyncState(object):
+    """ What the last downloader run mirrored: photos, album/tag
+        memberships and the listing signature of each album/tag.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS photos (
+                id TEXT PRIMARY KEY, hash TEXT, synced REAL);
+            CREATE TABLE IF NOT EXISTS collections (
+                kind TEXT, name TEXT, signature TEXT, synced REAL,
+                PRIMARY KEY (kind, name));
+            CREATE TABLE IF NOT EXISTS members (
+                kind TEXT, name TEXT, photo_id TEXT, ext TEXT,
+                PRIMARY KEY (kind, name, photo_id));
+        """)
+        # columns added after the first release
+        for column in ("ext TEXT", "taken REAL"):
+            try:
+                self.db.execute("ALTER TABLE photos ADD COLUMN %s" % column)
+            except sqlite3.OperationalError:
+                pass
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key, )).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (key, value))
+        self.db.commit()
+
+    def has_photo(self, id_, hash_value):
+        return self.db.execute("SELECT 1 FROM photos WHERE id = ? "
+                               "AND hash = ?",
+                               (id_, hash_value)).fetchone() is not None
+
+    def add_photo(self, id_, hash_value, ext=None, taken=None):
+        self.db.execute("INSERT OR REPLACE INTO photos "
+                        "(id, hash, synced, ext, taken) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (id_, hash_value, time.time(), ext, taken))
+
+    def photos(self):
+        """ (id, ext, taken) of every mirrored photo """
+        return self.db.execute("SELECT id, ext, taken FROM photos")
+
+    def signature(self, kind, name):
+        row = self.db.execute("SELECT signature FROM collections "
+                              "WHERE kind = ? AND name = ?",
+                              (kind, name)).fetchone()
+        return row[0] if row else None
+
+    def members(self, kind, name):
+        return dict(self.db.execute("SELECT photo_id, ext FROM members "
+                                    "WHERE kind = ? AND name = ?",
+                                    (kind, name)))
+
+    def set_members(self, kind, name, members, signature=None):
+        self.db.execute("DELETE FROM members WHERE kind = ? AND name = ?",
+                        (kind, name))
+        self.db.executemany("INSERT INTO members VALUES (?, ?, ?, ?)",
+                            ((kind, name, id_, ext)
+                             for id_, ext in members.items()))
+        self.db.execute("INSERT OR REPLACE INTO collections "
+                        "VALUES (?, ?, ?, ?)",
+                        (kind, name, signature, time.time()))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+PhotoRecord = namedtuple("PhotoRecord", "id hash filename_original")
+
+
+class HashStore(object):
+    """ Persistent hash -> PhotoRecord map of the remote photos.
+        Safe to share between threads; inserts are committed in small
+        batches so an aborted run keeps what it learned.
+    """
+    commit_every = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.db = connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS photos (
+                hash TEXT PRIMARY KEY, id TEXT, filename_original TEXT);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.db.commit()
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def get(self, hash_value, default=None):
+        with self._lock:
+            row = self.db.execute("SELECT id, hash, filename_original "
+                                  "FROM photos WHERE hash = ?",
+                                  (hash_value, )).fetchone()
+        return PhotoRecord(*row) if row else default
+
+    def __contains__(self, hash_value):
+        return self.get(hash_value) is not None
+
+    def add(self, photo):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO photos VALUES (?, ?, ?)",
+                            (photo.hash, photo.id,
+                             getattr(photo, "filename_original", None)))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def __setitem__(self, hash_value, photo):
+        self.add(photo)
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                                  (key, )).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                            (key, value))
+            self.db.commit()
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM photos")
+            self.db.execute("DELETE FROM meta")
+            self.db.commit()
+
+    def commit(self):
+        with self._lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def mtime_ns(st):
+    value = getattr(st, "st_mtime_ns", None)
+    if value is None:
+        value = int(st.st_mtime * 1000000000)
+    return value
+
+
+class HashCache(object):
+    """ Persistent cache of local file hashes, keyed by device and inode.
+        A file is only read again when its size or mtime change.
+    """
+    commit_every = 100
+
+    def __init__(self, path, rehash=False):
+        self.path = path
+        self.rehash = rehash
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.db = connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "dev INTEGER, inode INTEGER, size INTEGER, "
+                        "mtime_ns INTEGER, hash TEXT, "
+                        "PRIMARY KEY (dev, inode))")
+        self.db.commit()
+        self._lock = threading.Lock()
+
+    def hash(self, path):
+        value, st = self.lookup(path)
+        if value is None:
+            value = hash_file(path)
+            self.store(st, value)
+        return value
+
+    def lookup(self, path):
+        """ (cached hash or None, stat) of path """
+        st = os.stat(path)
+        if self.rehash:
+            return None, st
+
+        with self._lock:
+            row = self.db.execute("SELECT hash FROM files WHERE dev = ? "
+                                  "AND inode = ? AND size = ? AND "
+                                  "mtime_ns = ?",
+                                  (st.st_dev, st.st_ino, st.st_size,
+                                   mtime_ns(st))).fetchone()
+            if row:
+                self.hits += 1
+        if row:
+            instrument.incr("hash_cache.hits")
+            return row[0], st
+        return None, st
+
+    def store(self, st, value):
+        """ Remember the hash of the file stat was taken from """
+        instrument.incr("hash_cache.misses")
+        with self._lock:
+            self.misses += 1
+            self.db.execute("INSERT OR REPLACE INTO files "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (st.st_dev, st.st_ino, st.st_size, mtime_ns(st),
+                             value))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def commit(self):
+        with self._lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
+
+
+class Journal(object):
+    """ Outcome of every file handled by the importer.
+        Entries remember the size and mtime of the file, so a file which
+        changed since it was handled is handled again.
+    """
+    DONE = ("uploaded", "updated", "skipped")
+    commit_every = 20
+
+    def __init__(self, path):
+        self.path = path
+        self.counts = {}
+        self.pending = 0
+        self.db = connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                        "album TEXT, status TEXT, reason TEXT, updated REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_status "
+                        "ON files (status)")
+        self.db.commit()
+        self._lock = threading.Lock()
+
+    def record(self, path, status, album=None, reason=None):
+        path = os.path.realpath(path)
+        try:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size = mtime = None
+
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.db.execute("INSERT OR REPLACE INTO files "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (path, size, mtime, album, status, reason,
+                             time.time()))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def is_done(self, path):
+        path = os.path.realpath(path)
+        with self._lock:
+            row = self.db.execute("SELECT size, mtime, status FROM files "
+                                  "WHERE path = ?", (path, )).fetchone()
+        if not row or row[2] not in self.DONE:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return row[0] == st.st_size and row[1] == st.st_mtime
+
+    def failed(self):
+        """ (path, album name, reason) of the files which failed """
+        with self._lock:
+            return self.db.execute("SELECT path, album, reason FROM files "
+                                   "WHERE status = 'failed' "
+                                   "ORDER BY album, path").fetchall()
+
+    def summary(self):
+        return ", ".join("%d %s" % (v, k)
+                         for k, v in sorted(self.counts.items()))
+
+    def commit(self):
+        with self._lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,97 @@
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    try:
+        from requests.packages.urllib3.util.retry import Retry
+    except ImportError:
+        Retry = None
+from . import instrument
+
+__all__ = ["Adapter", "Session", "make_adapter", "make_session", "mount"]
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Session(requests.Session):
+    """ A requests Session with a default timeout """
+
+    def __init__(self, timeout=None):
+        super(Session, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(Session, self).request(method, url, **kwargs)
+
+
+class Adapter(HTTPAdapter):
+    """ An HTTPAdapter counting requests, errors and received bytes,
+        optionally throttled by a RateLimiter, with a default timeout for
+        sessions not setting one
+    """
+
+    def __init__(self, limiter=None, timeout=None, **kwargs):
+        self.limiter = limiter
+        self.timeout = timeout
+        super(Adapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        instrument.incr("http.requests")
+        if self.limiter:
+            self.limiter.request(content_length(request.headers))
+        try:
+            response = super(Adapter, self).send(request, **kwargs)
+        except Exception:
+            instrument.incr("http.errors")
+            raise
+        if response.status_code >= 400:
+            instrument.incr("http.errors")
+        length = content_length(response.headers)
+        if length:
+            instrument.incr("http.bytes", length)
+            if self.limiter:
+                self.limiter.transfer(length)
+        return response
+
+
+def content_length(headers):
+    length = headers.get("Content-Length")
+    if length and length.isdigit():
+        return int(length)
+    return 0
+
+
+def make_adapter(pool_size=10, retries=5, backoff=0.5, limiter=None,
+                 timeout=None):
+    if Retry is not None:
+        max_retries = Retry(total=retries, backoff_factor=backoff,
+                            status_forcelist=RETRY_STATUSES)
+    else:
+        # old urllib3: only connection errors are retried
+        max_retries = retries
+
+    return Adapter(limiter, timeout, pool_connections=pool_size,
+                   pool_maxsize=pool_size, max_retries=max_retries)
+
+
+def mount(session, adapter):
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def make_session(pool_size=10, timeout=None, retries=5, backoff=0.5,
+                 limiter=None):
+    """ Build a keep-alive session with a connection pool and
+        exponential backoff retries on connection errors and 5xx/429
+    """
+    log.debug("Creating session (pool: %s, timeout: %s, retries: %s, "
+              "limiter: %s)", pool_size, timeout, retries, limiter)
+    return mount(Session(timeout),
+                 make_adapter(pool_size, retries, backoff, limiter, timeout))
@@ -0,0 +1,177 @@
+""" Audit the .photos mirror built by the downloader against the remote
+    hashes, without downloading anything.
+"""
+import logging
+import multiprocessing
+import os
+from itertools import chain
+from . import instrument
+from .hashing import hash_file
+from .paging import iter_photos
+from .store import HashCache
+from .workers import (HostLimiter,
+                      WorkerPool)
+
+__all__ = ["Audit", "AuditFailed", "audit"]
+log = logging.getLogger(__name__)
+READ_SIZE = 8 * 1024 * 1024
+
+
+class AuditFailed(OSError):
+    pass
+
+
+class Audit(object):
+    """ Outcome of an audit: ids of the missing, extra and mismatched
+        photos, and the remote photos which need downloading
+    """
+
+    def __init__(self):
+        self.checked = 0
+        self.missing = []
+        self.extra = []
+        self.mismatched = []
+        self.bad = []
+
+    @property
+    def ok(self):
+        return not (self.missing or self.extra or self.mismatched)
+
+    def __str__(self):
+        return "%d photos checked: %d missing, %d extra, %d mismatched" % (
+            self.checked, len(self.missing), len(self.extra),
+            len(self.mismatched))
+
+
+def hash_worker(path):
+    """ Run in the process pool: (path, hash or None, error) """
+    try:
+        return path, hash_file(path, True, READ_SIZE), None
+    except (IOError, OSError) as e:
+        return path, None, str(e)
+
+
+def local_ids(photo_dir):
+    return set(name for name in os.listdir(photo_dir)
+               if not name.endswith(".part") and not name.startswith("."))
+
+
+def audit(config, destination, jobs=None, repair=False, rehash=False,
+          download_jobs=4):
+    """ Compare destination/.photos with the remote photos.
+        Files are hashed on a pool of jobs processes, unless the cache of
+        verified files already knows them unchanged. With repair the
+        missing and mismatched photos are downloaded again.
+    """
+    photo_dir = os.path.join(destination, ".photos")
+    if not os.path.isdir(photo_dir):
+        raise OSError("No such directory '%s'" % (photo_dir))
+
+    result = Audit()
+    cache = HashCache(os.path.join(destination, ".verified.sqlite"), rehash)
+    local = local_ids(photo_dir)
+    pending = {}
+    errors = []
+
+    def unverified():
+        """ Paths of the listed photos which need hashing. Runs in the
+            thread feeding the pool, so errors are handed over to audit
+        """
+        try:
+            for photo in iter_photos(config.client):
+                result.checked += 1
+                if photo.id not in local:
+                    result.missing.append(photo.id)
+                    result.bad.append(photo)
+                    continue
+
+                local.discard(photo.id)
+                path = os.path.join(photo_dir, photo.id)
+                value, st = cache.lookup(path)
+                if value is None:
+                    pending[path] = photo
+                    yield path
+                elif photo.hash and value != photo.hash:
+                    mismatch(result, photo)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        paths = unverified()
+        first = next(paths, None)
+        if first is not None:
+            hash_files(chain([first], paths), pending, jobs, result, cache)
+        if errors:
+            raise errors[0]
+        result.extra = sorted(local)
+        log.info("%d files verified before", cache.hits)
+    finally:
+        cache.close()
+
+    instrument.incr("verify.missing", len(result.missing))
+    instrument.incr("verify.extra", len(result.extra))
+    instrument.incr("verify.mismatched", len(result.mismatched))
+    report(result)
+
+    if repair and result.bad:
+        redownload(config, photo_dir, result.bad, download_jobs)
+
+    if not result.ok and not repair:
+        raise AuditFailed(str(result))
+    return result
+
+
+def hash_files(paths, pending, jobs, result, cache):
+    """ Hash paths on a pool of jobs processes while they are listed """
+    pool = multiprocessing.Pool(jobs or None)
+    try:
+        for path, value, error in pool.imap_unordered(hash_worker, paths,
+                                                      16):
+            photo = pending.pop(path)
+            instrument.incr("verify.hashed")
+            if value is None:
+                log.error("Cannot read %s: %s", path, error)
+                mismatch(result, photo)
+            elif photo.hash and value != photo.hash:
+                mismatch(result, photo)
+            else:
+                cache.store(os.stat(path), value)
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
+def mismatch(result, photo):
+    result.mismatched.append(photo.id)
+    result.bad.append(photo)
+
+
+def report(result):
+    for kind in ("missing", "extra", "mismatched"):
+        for id_ in getattr(result, kind):
+            print("%-10s %s" % (kind, id_))
+    log.info("%s", result)
+
+
+def redownload(config, photo_dir, photos, jobs=4):
+    from .downloader import (TransferStats,
+                             download_photo,
+                             photo_host)
+
+    log.info("Downloading %d photos again", len(photos))
+    stats = TransferStats()
+    limiter = HostLimiter(4)
+    with WorkerPool(jobs, name="repair") as pool:
+        for photo in photos:
+            path = os.path.join(photo_dir, photo.id)
+            if os.path.isfile(path):
+                os.unlink(path)
+            pool.submit(download_photo, photo, path,
+                        limiter.get(photo_host(photo, config.api.host)),
+                        stats, config.session, config.client)
+    log.info("%s", stats)
+    if stats.errors:
+        raise AuditFailed("%d photos could not be repaired" % stats.errors)
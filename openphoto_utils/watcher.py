@@ -0,0 +1,253 @@
+""" Notice new and modified files below some directories.
+    Uses inotify where available (through libc, no extra dependency) and
+    falls back to scanning the directories periodically, also when some
+    directory cannot be watched (e.g. past fs.inotify.max_user_watches).
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from .scanner import list_dir
+
+__all__ = ["Watcher"]
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct("iIII")
+
+
+class Inotify(object):
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.paths = {}
+
+    def add(self, path):
+        """ Watch path, returning whether it could be """
+        wd = self._add_watch(self.fd, path.encode("utf-8")
+                             if not isinstance(path, bytes) else path,
+                             WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            log.warning("Cannot watch %s: %s", path, os.strerror(err))
+            return False
+        self.paths[wd] = path
+        return True
+
+    def read(self, timeout):
+        """ (path, mask) of the events within timeout seconds, with path
+            None on queue overflows
+        """
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                directory = self.paths[wd]
+                if not isinstance(directory, bytes):
+                    name = name.decode("utf-8", "replace")
+                events.append((os.path.join(directory, name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """ Yield batches of (root, path) of files created or modified below
+        roots which are accepted by scanner.
+        A file is only yielded once its size and mtime didn't change for
+        debounce seconds, so files still being copied are left alone.
+    """
+
+    def __init__(self, roots, scanner, debounce=5.0, poll_interval=30.0):
+        self.roots = [os.path.realpath(r) for r in roots]
+        self.scanner = scanner
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.inotify = None
+        self.snapshot = None
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+        except (AttributeError, OSError) as e:
+            log.info("inotify not available (%s), polling every %ss", e,
+                     self.poll_interval)
+            self.snapshot = self.poll()
+            return
+
+        for root in self.roots:
+            self.watch_tree(root, root, notify=False)
+            if self.inotify is None:
+                return
+        log.info("Watching %d directories", len(self.inotify.paths))
+
+    def fall_back(self):
+        """ Poll the roots instead of watching them """
+        if self.inotify is None:
+            return
+        log.warning("Cannot watch every directory, polling every %ss",
+                    self.poll_interval)
+        self.inotify.close()
+        self.inotify = None
+        self.snapshot = self.poll()
+
+    def watch(self, directory):
+        return self.inotify is not None and self.inotify.add(directory)
+
+    def watch_tree(self, root, directory, notify=True):
+        """ Watch directory and, when recursing, its subdirectories.
+            With notify the files already there are queued too, as they
+            may have been created before the watch.
+            If a directory cannot be watched, the whole tree is still
+            walked, then the watcher falls back to polling.
+        """
+        watched = self.watch(directory)
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            try:
+                entries = list_dir(current)
+            except OSError:
+                continue
+            for name, is_dir in entries:
+                path = os.path.join(current, name)
+                relpath = os.path.relpath(path, root)
+                if is_dir:
+                    if self.recurse_into(name, relpath):
+                        watched = self.watch(path) and watched
+                        stack.append(path)
+                elif notify:
+                    self.changed(root, path)
+        if not watched:
+            self.fall_back()
+
+    def recurse_into(self, name, relpath):
+        scanner = self.scanner
+        return scanner.recurse and not (
+            scanner.exclude and scanner.matches(scanner.exclude, name,
+                                                relpath))
+
+    def root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(os.path.join(root, "")):
+                return root
+        return None
+
+    def changed(self, root, path):
+        if path in self.pending or \
+                self.scanner.accept(path, os.path.relpath(path, root)):
+            self.pending[path] = (root, None, time.time())
+
+    def poll(self):
+        """ Scan the roots, queueing files which are new or changed since
+            the last scan
+        """
+        snapshot = {}
+        for root in self.roots:
+            for path, parent in self.scanner.scan(root):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime)
+                if self.snapshot is not None and \
+                        self.snapshot.get(path) != snapshot[path]:
+                    self.pending[path] = (root, None, time.time())
+        return snapshot
+
+    def wait(self, timeout):
+        if self.inotify is None:
+            time.sleep(timeout)
+            self.snapshot = self.poll()
+            return
+
+        for path, mask in self.inotify.read(timeout):
+            if path is None:
+                log.warning("Too many changes at once, rescanning")
+                for root in self.roots:
+                    self.watch_tree(root, root)
+                continue
+
+            root = self.root_of(path)
+            if root is None:
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and \
+                        self.recurse_into(os.path.basename(path),
+                                          os.path.relpath(path, root)):
+                    self.watch_tree(root, path)
+            elif os.path.dirname(path) == root or self.scanner.recurse:
+                self.changed(root, path)
+
+    def ready(self):
+        """ Pop the pending files which stopped changing """
+        now = time.time()
+        batch = []
+        for path, (root, signature, since) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            current = (st.st_size, st.st_mtime)
+            if current != signature:
+                self.pending[path] = (root, current, now)
+            elif now - since >= self.debounce:
+                del self.pending[path]
+                batch.append((root, path))
+        batch.sort()
+        return batch
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                if self.inotify is not None:
+                    timeout = min(self.debounce, 1.0) if self.pending \
+                        else 60.0
+                else:
+                    timeout = self.poll_interval
+                self.wait(timeout)
+                batch = self.ready()
+                if batch:
+                    yield batch
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
@@ -0,0 +1,243 @@
+import itertools
+import logging
+import threading
+from . import instrument
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+__all__ = ["WorkerPool", "KeyedWorkerPool", "HostLimiter", "Pending", "Budget",
+           "Sequencer"]
+log = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """ Run jobs on a fixed number of threads.
+        Jobs are fed through a bounded queue, so submit() blocks when
+        the workers are behind instead of buffering the whole library.
+    """
+
+    def __init__(self, size, queue_size=None, name="worker"):
+        self.size = max(1, int(size))
+        self.queues = self._make_queues(queue_size)
+        self.name = name
+        self.threads = []
+        self.errors = 0
+        self.registry = instrument.current()
+        self._lock = threading.Lock()
+
+    def _make_queues(self, queue_size):
+        # all the threads share the same queue
+        return [queue.Queue(queue_size or self.size * 2)] * self.size
+
+    def start(self):
+        for i in range(self.size):
+            t = threading.Thread(target=self._work, args=(self.queues[i], ),
+                                 name="%s-%d" % (self.name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def submit(self, fun, *args, **kwargs):
+        self.queues[0].put((fun, args, kwargs))
+
+    def _work(self, queue_):
+        instrument.bind(self.registry)
+        while True:
+            item = queue_.get()
+            try:
+                if item is None:
+                    return
+                fun, args, kwargs = item
+                fun(*args, **kwargs)
+
+            except Exception:
+                log.exception("Error in %s", threading.current_thread().name)
+                with self._lock:
+                    self.errors += 1
+
+            finally:
+                queue_.task_done()
+
+    def join(self):
+        for q in self.queues[:len(self.threads)]:
+            q.put(None)
+        for t in self.threads:
+            # join with a timeout so KeyboardInterrupt is delivered
+            while t.is_alive():
+                t.join(0.5)
+        self.threads = []
+
+    def drain(self):
+        """ Drop the jobs not started yet """
+        for q in set(self.queues):
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+                q.task_done()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        # on errors only the jobs already running are waited for, so
+        # nothing outlives the caller
+        if exc_type is not None:
+            self.drain()
+        self.join()
+
+
+class KeyedWorkerPool(WorkerPool):
+    """ A WorkerPool where jobs submitted with the same key always run
+        on the same thread, in submission order.
+        Jobs without a key (None) are spread over all the threads.
+    """
+
+    def _make_queues(self, queue_size):
+        self._next = itertools.count()
+        return [queue.Queue(queue_size or 2) for i in range(self.size)]
+
+    def submit(self, key, fun, *args, **kwargs):
+        if key is None:
+            index = next(self._next) % self.size
+        else:
+            index = hash(key) % self.size
+        self.queues[index].put((fun, args, kwargs))
+
+
+class Sequencer(object):
+    """ Let jobs sharing a key pass a point in the order they were
+        numbered, whatever thread runs them:
+
+        turn = sequencer.turn(key)  # when submitting
+        turn.wait()                 # in the job, before the ordered step
+        turn.release()              # let the next job of key through
+
+        Jobs must be picked up in the order they were numbered (as from a
+        WorkerPool queue), or waiting could deadlock.
+    """
+
+    def __init__(self):
+        self.issued = {}
+        self.passed = {}
+        self._cond = threading.Condition()
+
+    def turn(self, key):
+        with self._cond:
+            number = self.issued.get(key, 0)
+            self.issued[key] = number + 1
+        return Turn(self, key, number)
+
+    def wait(self, key, number):
+        with self._cond:
+            while self.passed.get(key, 0) != number:
+                self._cond.wait(0.5)
+
+    def done(self, key, number):
+        with self._cond:
+            self.passed[key] = number + 1
+            if self.passed[key] == self.issued[key]:
+                # nothing in flight for key
+                del self.passed[key]
+                del self.issued[key]
+            self._cond.notify_all()
+
+
+class Turn(object):
+
+    def __init__(self, sequencer, key, number):
+        self.sequencer = sequencer
+        self.key = key
+        self.number = number
+        self.waited = False
+        self.released = False
+
+    def wait(self):
+        if not self.waited:
+            self.sequencer.wait(self.key, self.number)
+            self.waited = True
+
+    def release(self):
+        """ Pass the turn on; jobs failing early still wait for theirs so
+            the order is kept
+        """
+        if not self.released:
+            self.wait()
+            self.released = True
+            self.sequencer.done(self.key, self.number)
+
+
+class Pending(object):
+    """ The result of a job which may not have run yet """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.value = None
+        self.error = None
+
+    @classmethod
+    def resolved(cls, value):
+        pending = cls()
+        pending.value = value
+        pending._event.set()
+        return pending
+
+    def run(self, fun, *args, **kwargs):
+        try:
+            self.value = fun(*args, **kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._event.set()
+
+    def get(self):
+        self._event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class HostLimiter(object):
+    """ Cap the number of concurrent requests against a single host """
+
+    def __init__(self, per_host):
+        self.per_host = max(1, int(per_host))
+        self.semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        with self._lock:
+            try:
+                return self.semaphores[host]
+            except KeyError:
+                sem = threading.BoundedSemaphore(self.per_host)
+                self.semaphores[host] = sem
+                return sem
+
+
+class Budget(object):
+    """ A number of workers shared by jobs which take several of them.
+        acquire() blocks until enough workers are free.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self.free = self.size
+        self._cond = threading.Condition()
+
+    def acquire(self, count):
+        count = min(count, self.size)
+        with self._cond:
+            while self.free < count:
+                self._cond.wait(0.5)
+            self.free -= count
+        return count
+
+    def release(self, count):
+        with self._cond:
+            self.free += count
+            self._cond.notify_all()
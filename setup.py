@@ -12,9 +12,12 @@ try:
     kw = {
         "entry_points": """
 [console_scripts]
-    openphoto-downloader = openphoto_utils.downloader:main
-    openphoto-shell = openphoto_utils.shell:main
-    openphoto-importer = openphoto_utils.importer:main
+    openphoto-downloader = openphoto_utils.cli:downloader
+    openphoto-shell = openphoto_utils.cli:shell
+    openphoto-importer = openphoto_utils.cli:importer
+    openphoto-serve = openphoto_utils.cli:serve
+    openphoto-verify = openphoto_utils.cli:verify
+    openphoto-batch = openphoto_utils.cli:batch
 """,
         "zip_safe": False,
         "install_requires": requires
@@ -23,7 +26,8 @@ except ImportError:
     from distutils.core import setup
     kw = {
         "scripts": ['scripts/openphoto-downloader', 'scripts/openphoto-shell',
-                    'scripts/openphoto-importer'],
+                    'scripts/openphoto-importer', 'scripts/openphoto-serve',
+                    'scripts/openphoto-verify', 'scripts/openphoto-batch'],
         "requires": "requires"
     }
 
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from openphoto_utils import downloader
+from openphoto_utils.paging import RemotePhoto
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class Response(object):
+
+    def __init__(self, status_code, body=b""):
+        self.status_code = status_code
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError("HTTP %d" % self.status_code)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 2):
+            yield self.body[i:i + 2]
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="downloader-")
+        self.path = os.path.join(self.directory, "1.part")
+        self.session = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, response, partial=None):
+        if partial is not None:
+            with open(self.path, "wb") as f:
+                f.write(partial)
+        self.session.get.return_value = response
+        digest = downloader.fetch(self.session, "http://host/1.jpg",
+                                  self.path)
+        with open(self.path, "rb") as f:
+            return digest, f.read()
+
+    def headers(self):
+        return self.session.get.call_args[1]["headers"]
+
+    def test_downloads_the_whole_file(self):
+        self.assertEqual(self.fetch(Response(200, b"photo")),
+                         (sha1(b"photo"), b"photo"))
+        self.assertEqual(self.headers(), {})
+
+    def test_resumes_a_partial_file(self):
+        self.assertEqual(self.fetch(Response(206, b"oto"), b"ph"),
+                         (sha1(b"photo"), b"photo"))
+        self.assertEqual(self.headers(), {"Range": "bytes=2-"})
+
+    def test_restarts_when_range_is_ignored(self):
+        self.assertEqual(self.fetch(Response(200, b"photo"), b"xx"),
+                         (sha1(b"photo"), b"photo"))
+
+    def test_complete_file_is_not_fetched_again(self):
+        self.assertEqual(self.fetch(Response(416), b"photo"),
+                         (sha1(b"photo"), b"photo"))
+        self.assertEqual(self.headers(), {"Range": "bytes=5-"})
+
+    def test_errors_keep_the_partial_file(self):
+        self.assertRaises(IOError, self.fetch, Response(503), b"ph")
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"ph")
+
+
+class VerifyPhotoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="downloader-")
+        self.path = os.path.join(self.directory, "1")
+        self.stats = downloader.TransferStats()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def listed(self, data):
+        # listed without a download URL, as older servers do
+        return RemotePhoto("1", sha1(data), "1.jpg", None, None, None)
+
+    def verify(self, photo, full=None):
+        with mock.patch.object(downloader.Photo, "get",
+                               return_value=full) as get:
+            downloader.verify_photo(photo, self.path, threading.Semaphore(),
+                                    self.stats, mock.Mock(), mock.Mock())
+        return get
+
+    def test_verified_photo_is_not_fetched(self):
+        self.write(self.path, b"photo")
+        get = self.verify(self.listed(b"photo"))
+        self.assertFalse(get.called)
+        self.assertEqual((self.stats.verified, self.stats.corrupted), (1, 0))
+
+    def test_corrupted_photo_is_fetched_by_the_worker(self):
+        self.write(self.path, b"phot0")
+        full = mock.Mock(id="1", hash=sha1(b"photo"), path_original=None)
+        full.download.side_effect = lambda part: self.write(part, b"photo")
+        get = self.verify(self.listed(b"photo"), full)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual((self.stats.corrupted, self.stats.photos), (1, 1))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"photo")
+
+
+if __name__ == '__main__':
+    unittest.main()
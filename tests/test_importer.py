@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from openphoto_utils import importer
+from openphoto_utils.scanner import ScanPosition
+
+
+class ImportPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="importer-")
+        self.targets = []
+        for i in range(8):
+            path = os.path.join(self.directory, "%d.jpg" % i)
+            with open(path, "wb") as f:
+                f.write(("photo %d" % i).encode("ascii"))
+            self.targets.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, albums, jobs=4):
+        """ Run the pipeline with the album of each target given by
+            albums, and return the threads and the albums of the uploads
+        """
+        threads = set()
+        uploaded = []
+        lock = threading.Lock()
+
+        def create(client, path, albums=None, **kwargs):
+            time.sleep(0.01)
+            with lock:
+                threads.add(threading.current_thread().name)
+                uploaded.append((albums, path))
+            return mock.Mock(id=os.path.basename(path))
+
+        config = mock.Mock()
+        with mock.patch.object(importer.Photo, "create", side_effect=create):
+            importer.import_pipeline(
+                config, ((path, album, None)
+                         for path, album in zip(self.targets, albums)),
+                jobs=jobs)
+        return threads, uploaded
+
+    def test_uploads_without_album_use_all_jobs(self):
+        threads, uploaded = self.upload([None] * len(self.targets))
+        self.assertTrue(len(threads) > 1)
+
+    def test_uploads_to_one_album_use_all_jobs(self):
+        # -a ALBUM
+        album = mock.Mock(id="trip")
+        album.name = "Trip"
+        threads, uploaded = self.upload([album] * len(self.targets))
+        self.assertTrue(len(threads) > 1)
+        self.assertEqual(sorted(uploaded),
+                         sorted(("trip", path) for path in self.targets))
+
+    def test_uploads_to_album_per_directory_use_all_jobs(self):
+        # -C, one album per directory
+        albums = [mock.Mock(id="a%d" % (i // 4)) for i in range(8)]
+        threads, uploaded = self.upload(albums)
+        self.assertTrue(len(threads) > 1)
+        self.assertEqual(len(uploaded), len(self.targets))
+
+    def test_interrupted_pipeline_waits_for_running_uploads(self):
+        uploaded = []
+
+        def create(client, path, **kwargs):
+            time.sleep(0.02)
+            uploaded.append(path)
+            return mock.Mock(id=os.path.basename(path))
+
+        def targets():
+            for path in self.targets[:5]:
+                yield path, None, None
+            raise RuntimeError("scan failed")
+
+        journal = mock.Mock()
+        hashes = mock.MagicMock()
+        hashes.get.return_value = None
+        with mock.patch.object(importer.Photo, "create", side_effect=create):
+            self.assertRaises(RuntimeError, importer.import_pipeline,
+                              mock.Mock(), targets(), hashes=hashes,
+                              hasher=lambda path: path, jobs=2,
+                              journal=journal)
+
+        alive = [t.name for t in threading.enumerate()
+                 if t.name.startswith(("upload-", "hash-"))]
+        self.assertEqual(alive, [])
+        recorded = [c[0][0] for c in journal.record.call_args_list]
+        self.assertEqual(sorted(recorded), sorted(uploaded))
+
+    def update_known(self, position, post):
+        """ Import the targets, all already uploaded, through batched
+            updates sent by post, reporting them to position
+        """
+        hashes = mock.MagicMock()
+        hashes.__contains__.return_value = True
+        hashes.get.side_effect = lambda h: mock.Mock(id=os.path.basename(h))
+        config = mock.Mock()
+        config.client.post.side_effect = post
+        targets = ((path, None, position.started(self.directory, path))
+                   for path in self.targets)
+        importer.import_pipeline(config, targets, hashes=hashes,
+                                 hasher=lambda path: path, jobs=2,
+                                 update_batch_size=100,
+                                 on_done=position.finished)
+
+    def test_position_moves_once_updates_are_sent(self):
+        position = ScanPosition(os.path.join(self.directory, "position"),
+                                [self.directory])
+        self.update_known(position, None)
+        self.assertEqual(position.position,
+                         (self.directory, os.path.basename(self.targets[-1])))
+
+    def test_position_stays_before_unsent_updates(self):
+        def interrupted(*args, **kwargs):
+            raise KeyboardInterrupt()
+
+        position = ScanPosition(os.path.join(self.directory, "position"),
+                                [self.directory])
+        self.assertRaises(KeyboardInterrupt, self.update_known, position,
+                          interrupted)
+        self.assertEqual(position.position, None)
+
+
+class UpdateBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.done = []
+        self.batcher = importer.UpdateBatcher(self.client, 3,
+                                              on_done=self.done.append)
+        self.album = importer.RemoteAlbum("7", "Trip")
+
+    def add(self, id_, **kwargs):
+        self.batcher.add(mock.Mock(id=id_), token=id_, **kwargs)
+
+    def posts(self):
+        return sorted(sorted(call[1].items())
+                      for call in self.client.post.call_args_list)
+
+    def test_groups_photos_with_the_same_update(self):
+        for id_ in "abcd":
+            self.add(id_, tags=["x"])
+        self.assertEqual(self.posts(), [[("ids", "a,b,c"), ("permission", 0),
+                                         ("tagsAdd", "x")]])
+        self.assertEqual(self.done, ["a", "b", "c"])
+
+        self.batcher.flush()
+        self.assertEqual(self.client.post.call_count, 2)
+        self.assertEqual(self.done, ["a", "b", "c", "d"])
+
+    def test_separates_different_updates(self):
+        self.add("a", tags=["x"])
+        self.add("b", tags=["y"])
+        self.add("c", tags=["x"], private=False)
+        self.add("d", tags=["x"], remove_tags=["old"], albums=self.album)
+        self.add("e", tags=["x"])
+        self.assertFalse(self.client.post.called)
+
+        self.batcher.flush()
+        self.assertEqual(self.posts(), [
+            [("albumsAdd", "7"), ("ids", "d"), ("permission", 0),
+             ("tagsAdd", "x"), ("tagsRemove", "old")],
+            [("ids", "a,e"), ("permission", 0), ("tagsAdd", "x")],
+            [("ids", "b"), ("permission", 0), ("tagsAdd", "y")],
+            [("ids", "c"), ("permission", 1), ("tagsAdd", "x")],
+        ])
+        self.assertEqual(sorted(self.done), list("abcde"))
+
+    def test_failed_updates_are_journaled(self):
+        journal = mock.Mock()
+        self.batcher.journal = journal
+        self.client.post.side_effect = importer.RequestException("down")
+        self.batcher.add(mock.Mock(id="a"), albums=self.album, path="a.jpg")
+        self.batcher.flush()
+        journal.record.assert_called_once_with("a.jpg", "failed", "Trip",
+                                               "down")
+
+
+class AlbumCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="albums-")
+        self.path = os.path.join(self.directory, "albums.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stores_only_ids_and_names(self):
+        trip = mock.Mock(id="1")
+        trip.name = "Trip"
+        client = mock.Mock(consumer_secret="secret")
+        with mock.patch.object(importer.Album, "all", return_value=[trip]):
+            albums = importer.AlbumCache(client, self.path)
+            self.assertEqual(albums.get("Trip"),
+                             importer.RemoteAlbum("1", "Trip"))
+        albums.save()
+
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        with open(self.path) as f:
+            self.assertNotIn("secret", f.read())
+        stored = importer.AlbumCache(client, self.path)
+        self.assertEqual(stored.albums,
+                         {"Trip": importer.RemoteAlbum("1", "Trip")})
+
+
+if __name__ == '__main__':
+    unittest.main()
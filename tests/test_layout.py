@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from openphoto_utils.layout import Layout
+
+
+class LayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        self.photo_dir = os.path.join(self.destination, ".photos")
+        os.mkdir(self.photo_dir)
+        for photo_id in ("1", "2", "a"):
+            self.write(os.path.join(".photos", photo_id), photo_id)
+
+        os.mkdir(os.path.join(self.destination, "Notes"))
+        self.write(os.path.join("Notes", "1.txt"), "notes")
+        self.write(os.path.join("Notes", "a.doc"), "document")
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def write(self, relpath, content):
+        with open(os.path.join(self.destination, relpath), "w") as f:
+            f.write(content)
+
+    def path(self, *parts):
+        return os.path.join(self.destination, *parts)
+
+    def apply(self, mode, wanted):
+        layout = Layout(self.destination, self.photo_dir, mode)
+        for relpath, photo_id in wanted.items():
+            layout.add(relpath, photo_id)
+        return layout.apply()
+
+    def check_unrelated_files_kept(self, mode):
+        wanted = {os.path.join("Trip", "1.jpg"): "1",
+                  os.path.join("Trip", "a.jpg"): "a"}
+        self.assertEqual(self.apply(mode, wanted), (2, 0))
+        self.assertEqual(self.apply(mode, wanted), (0, 0))
+
+        self.assertEqual(self.apply(mode, {}), (0, 2))
+        self.assertFalse(os.path.exists(self.path("Trip")))
+        self.assertTrue(os.path.isfile(self.path("Notes", "1.txt")))
+        self.assertTrue(os.path.isfile(self.path("Notes", "a.doc")))
+
+    def test_hardlink_keeps_unrelated_files(self):
+        self.check_unrelated_files_kept("hardlink")
+
+    def test_symlink_keeps_unrelated_files(self):
+        self.check_unrelated_files_kept("symlink")
+
+    def test_reflink_keeps_unrelated_files(self):
+        self.check_unrelated_files_kept("reflink")
+
+    def test_does_not_replace_unrelated_files(self):
+        created, removed = self.apply(
+            "hardlink", {os.path.join("Notes", "1.txt"): "1"})
+        self.assertEqual((created, removed), (0, 0))
+        with open(self.path("Notes", "1.txt")) as f:
+            self.assertEqual(f.read(), "notes")
+
+    def test_switching_modes_replaces_links(self):
+        wanted = {os.path.join("Trip", "2.jpg"): "2"}
+        self.apply("hardlink", wanted)
+        self.assertEqual(self.apply("symlink", wanted), (1, 0))
+        self.assertTrue(os.path.islink(self.path("Trip", "2.jpg")))
+
+
+if __name__ == '__main__':
+    unittest.main()
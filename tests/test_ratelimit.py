@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from openphoto_utils import ratelimit
+from openphoto_utils.ratelimit import (RateLimiter,
+                                       SharedTokenBucket,
+                                       TokenBucket,
+                                       parse_rate)
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ParseRateTest(unittest.TestCase):
+
+    def test_plain_numbers(self):
+        self.assertEqual(parse_rate("10"), 10.0)
+        self.assertEqual(parse_rate("0.5"), 0.5)
+        self.assertEqual(parse_rate(3), 3.0)
+
+    def test_suffixes(self):
+        self.assertEqual(parse_rate("512K"), 512 * 1024.0)
+        self.assertEqual(parse_rate("2mb"), 2 * 1024 ** 2.0)
+        self.assertEqual(parse_rate(" 1 G "), 1024 ** 3.0)
+
+    def test_unset(self):
+        self.assertIsNone(parse_rate(None))
+        self.assertIsNone(parse_rate(""))
+        self.assertIsNone(parse_rate("0"))
+
+    def test_invalid(self):
+        for value in ("fast", "1T", "-1", "1 k s"):
+            self.assertRaises(ValueError, parse_rate, value)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(ratelimit.time, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refill_is_capped_by_burst(self):
+        bucket = TokenBucket("test", 2, burst=4)
+        self.assertEqual(bucket.refill(0.0, 1000.0, 0, 1001.0), (2.0, 0.0))
+        self.assertEqual(bucket.refill(0.0, 1000.0, 0, 1010.0), (4.0, 0.0))
+        # a clock going back never removes tokens
+        self.assertEqual(bucket.refill(1.0, 1000.0, 0, 990.0), (1.0, 0.0))
+
+    def test_refill_waits_off_debt(self):
+        bucket = TokenBucket("test", 2, burst=4)
+        self.assertEqual(bucket.refill(4.0, 1000.0, 10, 1000.0), (-6.0, 3.0))
+
+    def test_reserve_burst_then_rate(self):
+        bucket = TokenBucket("test", 10)
+        for i in range(10):
+            self.assertEqual(bucket.reserve(1), 0.0)
+        self.assertAlmostEqual(bucket.reserve(1), 0.1)
+        self.assertAlmostEqual(bucket.reserve(1), 0.2)
+
+        self.clock.now += 0.5
+        self.assertAlmostEqual(bucket.reserve(1), 0.0)
+
+    def test_large_take_slows_down_the_next_ones(self):
+        bucket = TokenBucket("bytes", 100)
+        self.assertAlmostEqual(bucket.reserve(300), 2.0)
+        self.clock.now += 2.0
+        self.assertAlmostEqual(bucket.reserve(50), 0.5)
+
+    def test_take_sleeps(self):
+        bucket = TokenBucket("test", 1)
+        with mock.patch.object(ratelimit.time, "sleep") as sleep:
+            bucket.take()
+            self.assertFalse(sleep.called)
+            bucket.take()
+            sleep.assert_called_once_with(1.0)
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        if ratelimit.fcntl is None:
+            self.skipTest("fcntl not available")
+        self.clock = Clock()
+        patcher = mock.patch.object(ratelimit.time, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp(prefix="ratelimit-")
+        self.path = os.path.join(self.directory, "host.ratelimit")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def bucket(self, name="requests"):
+        return SharedTokenBucket(name, 10, path=self.path)
+
+    def state(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_buckets_share_the_file(self):
+        first, second = self.bucket(), self.bucket()
+        for i in range(5):
+            self.assertEqual(first.reserve(1), 0.0)
+            self.assertEqual(second.reserve(1), 0.0)
+        self.assertAlmostEqual(first.reserve(1), 0.1)
+        self.assertTrue(first.shared and second.shared)
+        self.assertEqual(self.state(), {"requests": [-1.0, 1000.0]})
+
+    def test_buckets_are_stored_by_name(self):
+        self.bucket("requests").reserve(1)
+        self.bucket("bytes").reserve(4)
+        self.assertEqual(self.state(), {"requests": [9.0, 1000.0],
+                                        "bytes": [6.0, 1000.0]})
+
+    def test_state_file_is_private(self):
+        self.bucket().reserve(1)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_corrupted_state_is_reset(self):
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        self.assertEqual(self.bucket().reserve(1), 0.0)
+        self.assertEqual(self.state(), {"requests": [9.0, 1000.0]})
+
+    def test_symlink_falls_back_to_process_budget(self):
+        if not hasattr(os, "O_NOFOLLOW"):
+            self.skipTest("O_NOFOLLOW not available")
+        target = os.path.join(self.directory, "target")
+        os.symlink(target, self.path)
+        bucket = self.bucket()
+        self.assertEqual(bucket.reserve(1), 0.0)
+        self.assertFalse(bucket.shared)
+        self.assertFalse(os.path.exists(target))
+
+        for i in range(9):
+            bucket.reserve(1)
+        self.assertAlmostEqual(bucket.reserve(1), 0.1)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_buckets(self):
+        limiter = RateLimiter(max_rps=5, max_bandwidth=1024)
+        self.assertIsInstance(limiter.requests, TokenBucket)
+        self.assertEqual(limiter.requests.burst, 5.0)
+        self.assertEqual(limiter.bandwidth.rate, 1024.0)
+        self.assertIsNone(RateLimiter().requests)
+
+    def test_shared_buckets(self):
+        limiter = RateLimiter(max_rps=5, path="/nonexistent/host.ratelimit")
+        if ratelimit.fcntl is None:
+            self.assertIsNone(limiter.path)
+        else:
+            self.assertIsInstance(limiter.requests, SharedTokenBucket)
+        self.assertIsNone(limiter.bandwidth)
+
+
+if __name__ == '__main__':
+    unittest.main()
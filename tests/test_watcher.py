@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from openphoto_utils.scanner import Scanner
+from openphoto_utils.watcher import Inotify, Watcher
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp(prefix="watcher-"))
+        os.mkdir(os.path.join(self.root, "full"))
+        self.write("full", "old.jpg")
+        self.watcher = Watcher([self.root], Scanner(), debounce=0)
+
+    def tearDown(self):
+        if self.watcher.inotify is not None:
+            self.watcher.inotify.close()
+        shutil.rmtree(self.root)
+
+    def write(self, *parts):
+        path = os.path.join(self.root, *parts)
+        with open(path, "w") as f:
+            f.write("data")
+        return path
+
+    def fail_on(self, name):
+        add = Inotify.add
+
+        def add_unless(inotify, path):
+            if os.path.basename(path) == name:
+                return False
+            return add(inotify, path)
+        return mock.patch.object(Inotify, "add", add_unless)
+
+    def test_polls_when_a_directory_cannot_be_watched(self):
+        with self.fail_on("full"):
+            self.watcher.start()
+
+        self.assertIsNone(self.watcher.inotify)
+        self.assertFalse(self.watcher.pending)
+        path = self.write("full", "new.jpg")
+        self.watcher.wait(0)
+        self.assertEqual(list(self.watcher.pending), [path])
+
+    def test_polls_when_a_new_directory_cannot_be_watched(self):
+        self.watcher.start()
+        if self.watcher.inotify is None:
+            self.skipTest("inotify not available")
+
+        with self.fail_on("new"):
+            os.mkdir(os.path.join(self.root, "new"))
+            first = self.write("new", "first.jpg")
+            self.watcher.wait(1.0)
+        self.assertIsNone(self.watcher.inotify)
+        self.assertEqual(list(self.watcher.pending), [first])
+
+        second = self.write("new", "second.jpg")
+        self.watcher.wait(0)
+        self.assertEqual(sorted(self.watcher.pending), [first, second])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import random
+import threading
+import time
+import unittest
+from openphoto_utils.workers import (KeyedWorkerPool,
+                                     Sequencer,
+                                     WorkerPool)
+
+
+class KeyedWorkerPoolTest(unittest.TestCase):
+
+    def run_jobs(self, keys):
+        threads = {}
+        lock = threading.Lock()
+
+        def job(key, i):
+            with lock:
+                threads.setdefault(key, []).append(
+                    (threading.current_thread().name, i))
+
+        with KeyedWorkerPool(4, name="test") as pool:
+            for i, key in enumerate(keys):
+                pool.submit(key, job, key, i)
+        return threads
+
+    def test_same_key_same_thread_in_order(self):
+        threads = self.run_jobs(["a", "b"] * 10)
+        for key in ("a", "b"):
+            self.assertEqual(len(set(t for t, i in threads[key])), 1)
+            order = [i for t, i in threads[key]]
+            self.assertEqual(order, sorted(order))
+
+    def test_jobs_without_key_use_all_threads(self):
+        threads = self.run_jobs([None] * 8)
+        self.assertEqual(len(set(t for t, i in threads[None])), 4)
+
+
+
+class SequencerTest(unittest.TestCase):
+
+    def test_turns_pass_in_order(self):
+        sequencer = Sequencer()
+        passed = []
+
+        def job(turn, key, i):
+            time.sleep(random.random() / 100)
+            turn.wait()
+            passed.append((key, i))
+            turn.release()
+
+        with WorkerPool(4, name="test") as pool:
+            for i in range(20):
+                key = "ab"[i % 2]
+                pool.submit(job, sequencer.turn(key), key, i)
+
+        for key in "ab":
+            order = [i for k, i in passed if k == key]
+            self.assertEqual(order, sorted(order))
+            self.assertEqual(len(order), 10)
+
+    def test_release_without_wait_keeps_order(self):
+        sequencer = Sequencer()
+        first, second = sequencer.turn("a"), sequencer.turn("a")
+        released = []
+
+        def release_second():
+            second.release()
+            released.append(2)
+
+        t = threading.Thread(target=release_second)
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(released, [])
+        first.release()
+        t.join()
+        self.assertEqual(released, [2])
+        self.assertEqual(sequencer.issued, {})
+
+
+if __name__ == '__main__':
+    unittest.main()